@@ -0,0 +1,210 @@
+"""
+CPU-only benchmarks for the host-side stages of the pipeline (no GPU, no vLLM engine).
+
+    python benchmark.py preprocess --pages 64 --workers 1,2,4,8
+    python benchmark.py render --input_path doc.pdf
+    python benchmark.py sam --sizes 640,1024
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+
+def synthetic_pages(num_pages, width=1224, height=1584, seed=0):
+    """Letter-size pages at 144 dpi with text-like dark strokes on white."""
+    rng = np.random.default_rng(seed)
+    pages = []
+    for _ in range(num_pages):
+        page = Image.new('RGB', (width, height), (255, 255, 255))
+        draw = ImageDraw.Draw(page)
+        for y in range(80, height - 80, 28):
+            x = 80
+            while x < width - 120:
+                word = int(rng.integers(20, 110))
+                draw.rectangle([x, y, x + word, y + 14], fill=tuple(int(v) for v in rng.integers(0, 80, 3)))
+                x += word + 12
+        pages.append(page)
+    return pages
+
+
+def worker_counts(arg):
+    if arg:
+        return [int(n) for n in arg.split(',')]
+    counts, n = [], 1
+    while n < os.cpu_count():
+        counts.append(n)
+        n *= 2
+    return counts + [os.cpu_count()]
+
+
+def bench_preprocess(args):
+    from process.preprocess_pool import make_preprocess_executor, preprocess_image
+
+    pages = synthetic_pages(args.pages)
+    print(f'{len(pages)} pages {pages[0].size[0]}x{pages[0].size[1]}, {os.cpu_count()} cores')
+    if os.cpu_count() == 1:
+        print('warning: 1 core, worker scaling cannot be measured on this machine')
+    print(f'{"backend":>8} {"workers":>8} {"pages/s":>9} {"speedup":>8}')
+    for backend in args.backends.split(','):
+        baseline = None
+        for workers in worker_counts(args.workers):
+            with make_preprocess_executor(backend=backend, max_workers=workers) as executor:
+                # warm up the pool so worker start-up is not timed
+                list(executor.map(preprocess_image, pages[:workers]))
+                start = time.perf_counter()
+                for _ in executor.map(preprocess_image, pages):
+                    pass
+                elapsed = time.perf_counter() - start
+            rate = len(pages) / elapsed
+            baseline = baseline or rate
+            print(f'{backend:>8} {workers:>8} {rate:>9.2f} {rate / baseline:>7.2f}x')
+
+
+def synthetic_pdf(num_pages):
+    """Write a text + vector-graphics PDF to a temp file and return its path."""
+    import fitz
+
+    doc = fitz.open()
+    for i in range(num_pages):
+        page = doc.new_page(width=612, height=792)
+        for line in range(40):
+            page.insert_text((54, 60 + line * 17), f'{i:04d}.{line:02d} ' + 'lorem ipsum dolor sit amet ' * 3, fontsize=9)
+        page.draw_rect(fitz.Rect(300, 420, 560, 700), color=(0, 0, 0.6), fill=(0.85, 0.9, 1.0))
+    path = os.path.join(tempfile.mkdtemp(), 'synthetic.pdf')
+    doc.save(path)
+    doc.close()
+    return path
+
+
+def _render_png(pixmap):
+    # the pre-existing path: PNG encode in MuPDF, decode in PIL
+    img = Image.open(io.BytesIO(pixmap.tobytes("png")))
+    img.load()
+    return img
+
+
+def _render_run(pdf_path, mode, dpi, result_queue):
+    import fitz
+    from process.pdf_render import pixmap_to_pil
+
+    convert = pixmap_to_pil if mode == 'raw' else _render_png
+    matrix = fitz.Matrix(dpi / 72.0, dpi / 72.0)
+    start = time.perf_counter()
+    with fitz.open(pdf_path) as doc:
+        for page in doc:
+            img = convert(page.get_pixmap(matrix=matrix, alpha=False))
+            img.convert('RGB')
+        num_pages = doc.page_count
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in KiB on Linux
+    result_queue.put((num_pages / elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def bench_render(args):
+    pdf_path = args.input_path or synthetic_pdf(args.pages)
+    # each mode runs in a fresh process so peak RSS is not shared between them
+    ctx = multiprocessing.get_context('spawn')
+    print(f'{pdf_path} @ {args.dpi} dpi')
+    print(f'{"mode":>6} {"pages/s":>9} {"peak RSS MiB":>13}')
+    for mode in ('png', 'raw'):
+        result_queue = ctx.Queue()
+        proc = ctx.Process(target=_render_run, args=(pdf_path, mode, args.dpi, result_queue))
+        proc.start()
+        rate, peak_rss = result_queue.get()
+        proc.join()
+        print(f'{mode:>6} {rate:>9.2f} {peak_rss:>13.1f}')
+
+
+def _sam_block(size):
+    import torch
+    from deepencoder.sam_vary_sdpa import Block
+
+    torch.manual_seed(0)
+    block = Block(dim=768, num_heads=12, mlp_ratio=4, qkv_bias=True, use_rel_pos=True, window_size=14,
+                  norm_layer=torch.nn.LayerNorm)
+    for param in block.parameters():
+        torch.nn.init.normal_(param, std=0.02)
+    x = torch.randn(1, size // 16, size // 16, 768)
+    return block, x
+
+
+def _partition_attention(block, x):
+    # the earlier path: pad + partition copies, attention over padded windows, unpartition copies
+    from deepencoder.sam_vary_sdpa import window_partition, window_unpartition
+
+    H, W = x.shape[1], x.shape[2]
+    windows, pad_hw = window_partition(x, block.window_size)
+    return window_unpartition(block.attn(windows), block.window_size, pad_hw, (H, W))
+
+
+def _sam_run(size, mode, iters, result_queue):
+    import torch
+
+    torch.set_num_threads(1)
+    block, x = _sam_block(size)
+    x = block.norm1(x)
+    if mode == 'partition':
+        attention = lambda: _partition_attention(block, x)
+    else:
+        attention = lambda: block.attn.forward_windowed(x, block.window_size)
+    with torch.no_grad():
+        attention()
+        start = time.perf_counter()
+        for _ in range(iters):
+            attention()
+        elapsed = time.perf_counter() - start
+    # ru_maxrss is in KiB on Linux
+    result_queue.put((elapsed / iters * 1000, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def bench_sam(args):
+    import torch
+
+    # each (size, mode) runs in a fresh process so peak RSS is not shared between them
+    ctx = multiprocessing.get_context('spawn')
+    print(f'windowed SAM attention (dim 768, 12 heads, window 14), 1 thread, {args.iters} iters')
+    print(f'{"input":>6} {"mode":>10} {"ms/iter":>9} {"peak RSS MiB":>13} {"max abs diff":>13}')
+    for size in (int(n) for n in args.sizes.split(',')):
+        block, x = _sam_block(size)
+        with torch.no_grad():
+            x = block.norm1(x)
+            diff = (_partition_attention(block, x) - block.attn.forward_windowed(x, block.window_size)).abs().max().item()
+        for mode in ('partition', 'gather'):
+            result_queue = ctx.Queue()
+            proc = ctx.Process(target=_sam_run, args=(size, mode, args.iters, result_queue))
+            proc.start()
+            latency, peak_rss = result_queue.get()
+            proc.join()
+            print(f'{size:>6} {mode:>10} {latency:>9.2f} {peak_rss:>13.1f} {diff if mode == "gather" else 0.0:>13.2e}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='DeepSeek OCR host-side benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    preprocess = subparsers.add_parser('preprocess', help='pages/sec of tokenize_with_images per pool backend')
+    preprocess.add_argument('--pages', type=int, default=64, help='Number of synthetic pages')
+    preprocess.add_argument('--workers', type=str, default='', help='Comma separated worker counts (default: 1,2,4,..,cores)')
+    preprocess.add_argument('--backends', type=str, default='thread,process', help='Comma separated pool backends')
+    preprocess.set_defaults(func=bench_preprocess)
+
+    render = subparsers.add_parser('render', help='pages/sec and peak RSS of PNG round-trip vs raw pixmap rendering')
+    render.add_argument('--input_path', type=str, default='', help='PDF to render (default: synthetic)')
+    render.add_argument('--pages', type=int, default=50, help='Pages of the synthetic PDF')
+    render.add_argument('--dpi', type=int, default=144, help='Render DPI')
+    render.set_defaults(func=bench_render)
+
+    sam = subparsers.add_parser('sam', help='latency and peak RSS of windowed SAM attention: partition copies vs gather')
+    sam.add_argument('--sizes', type=str, default='640,1024', help='Comma separated input sizes')
+    sam.add_argument('--iters', type=int, default=20, help='Timed iterations per input size')
+    sam.set_defaults(func=bench_sam)
+
+    args = parser.parse_args()
+    args.func(args)
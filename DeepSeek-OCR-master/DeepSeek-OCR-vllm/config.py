@@ -12,8 +12,26 @@ MIN_CROPS= 2
 MAX_CROPS= 6 # max:9; If your GPU memory is small, it is recommended to set it to 6.
 MAX_CONCURRENCY = 100 # If you have limited GPU memory, lower the concurrency count.
 NUM_WORKERS = 64 # image pre-process (resize/padding) workers 
+PREPROCESS_BACKEND = 'thread' # 'thread' or 'process': run NUM_WORKERS pre-process workers as threads or as processes (tensors returned via shared memory)
+PIPELINE_DEPTH = 32 # run_dpsk_ocr_pdf.py: max pages queued between the render / pre-process / engine / write stages
+RENDER_WORKERS = 1 # PDF rasterization processes (spawned once and shared, each keeps its own document handles); 1 renders in the calling thread. Each worker re-imports the main script and config (torch, vllm, tokenizer) at start-up, which costs seconds per worker: worth it in gradio_app.py or on long PDFs, slower on short ones
+RENDER_DPI_MODE = 'fixed' # 'fixed': always 144 dpi; 'adaptive': render each PDF page at the smallest zoom that fills its tile grid (faster, but the layout PDF and saved figure crops are drawn from these renders and can fall below 144 dpi)
+PDF_TEXT_FAST_PATH = False # take born-digital (text-native) PDF pages from their text layer instead of running OCR on them
+TENSOR_PREPROCESS = False # resize/normalize/tile pages as one uint8 tensor instead of per-tile PIL crops (within 2/255 of the PIL path)
+VISION_BATCH_SIZE = 16 # max views (local tiles or global views) per SAM/CLIP forward; views of different images share a batch
+VISION_CACHE_MB = 0 # > 0: keep up to this many MiB of vision embeddings (on the GPU) keyed by page content, so a page resubmitted with another prompt skips SAM/CLIP; costs a page hash in preprocessing and one small device->host read per batch
 PRINT_NUM_VIS_TOKENS = False
 SKIP_REPEAT = True
+REPETITION_ABORT = False # stop a page as soon as its output loops instead of decoding up to max_tokens (finish reason 'repetition'); also fires on valid repeats such as tables with identical rows or blank form rows, which SKIP_REPEAT then drops
+REPETITION_MAX_PERIOD = 512 # longest loop (in tokens) looked for
+REPETITION_MIN_REPEATS = 5 # a loop has to repeat this many times ...
+REPETITION_MIN_TOKENS = 400 # ... and span this many tokens before the page is stopped
+TOKEN_BUDGET_MODE = 'fixed' # run_dpsk_ocr_pdf.py: 'fixed': same max_tokens for every page; 'adaptive': cap each page's max_tokens by an (uncalibrated) estimate from its tile grid, ink density and text layer, pages reaching it are decoded again with the full max_tokens; no KV-cache saving with the V0 engine
+RESULT_CACHE_DIR = '' # directory of the on-disk OCR result cache (run_dpsk_ocr_pdf.py, gradio_app.py): pages already OCRed with the same pixels, prompt, mode, model and sampling params are not sent to the engine again; '' disables it
+RESULT_CACHE_MB = 1024 # size bound of RESULT_CACHE_DIR, least recently used results are evicted first
+GRADIO_CONCURRENCY = 4 # gradio_app.py: requests handled at once; they share one engine (on one event loop thread) and are batched together
+ENGINE_WARMUP = False # gradio_app.py: load the engine and decode one page per tile grid at startup instead of on the first request; /health reports 503 until done
+WARMUP_GRIDS = None # tile grids warmed up with ENGINE_WARMUP, e.g. ['untiled', '2x3']; None: every grid the planner can pick
 MODEL_PATH = 'deepseek-ai/DeepSeek-OCR' # change to your model path
 
 # TODO: change INPUT_PATH
@@ -128,6 +128,24 @@ class CLIPVisionEmbeddings(nn.Module):
             "position_ids", torch.arange(self.num_positions).expand((1, -1))
         )
 
+        # (target size, dtype, device) -> position embeddings resized by get_abs_pos
+        self._pos_embed_cache = {}
+
+    def clear_pos_embed_cache(self):
+        """Drop the resized position embeddings; call after position_embedding changes (weight load)."""
+        self._pos_embed_cache.clear()
+
+    def _abs_pos(self, tgt_size: int) -> torch.Tensor:
+        if torch.is_grad_enabled():
+            return get_abs_pos(self.position_embedding(self.position_ids), tgt_size)
+        weight = self.position_embedding.weight
+        key = (tgt_size, weight.dtype, weight.device)
+        pos_embed = self._pos_embed_cache.get(key)
+        if pos_embed is None:
+            pos_embed = get_abs_pos(self.position_embedding(self.position_ids), tgt_size)
+            self._pos_embed_cache[key] = pos_embed
+        return pos_embed
+
     def forward(self, pixel_values, patch_embeds):
         batch_size = pixel_values.shape[0]
         # patch_embeds = self.patch_embedding(
@@ -151,7 +169,7 @@ class CLIPVisionEmbeddings(nn.Module):
         embeddings = torch.cat([class_embeds, patch_embeds], dim=1)
 
         # x = torch.cat([cls_token, x], dim=1)
-        embeddings = embeddings + get_abs_pos(self.position_embedding(self.position_ids), embeddings.size(1))
+        embeddings = embeddings + self._abs_pos(embeddings.size(1))
         # embeddings = embeddings + self.position_embedding(self.position_ids)
         return embeddings
 
@@ -9,8 +9,11 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from typing import Optional, Tuple, Type
-from functools import partial
-from flash_attn import flash_attn_qkvpacked_func
+from functools import lru_cache, partial
+try:
+    from flash_attn import flash_attn_qkvpacked_func
+except ImportError:  # only referenced by commented-out code; lets the encoder run on CPU
+    flash_attn_qkvpacked_func = None
 # from .common import LayerNorm2d, MLPBlock
 
 # from mmgpt.model.vision_encoder.flash_4 import _attention_rel_h_rel_w
@@ -166,11 +169,27 @@ class ImageEncoderViT(nn.Module):
         self.net_2 = nn.Conv2d(256, 512, kernel_size=3, stride=2, padding=1, bias=False)
         self.net_3 = nn.Conv2d(512, 1024, kernel_size=3, stride=2, padding=1, bias=False)
 
+        # (target size, dtype, device) -> pos_embed resized by get_abs_pos
+        self._pos_embed_cache = {}
+
+    def clear_pos_embed_cache(self):
+        """Drop the resized positional embeddings; call after pos_embed changes (weight load)."""
+        self._pos_embed_cache.clear()
+
+    def _abs_pos(self, tgt_size: int) -> torch.Tensor:
+        if torch.is_grad_enabled():
+            return get_abs_pos(self.pos_embed, tgt_size)
+        key = (tgt_size, self.pos_embed.dtype, self.pos_embed.device)
+        pos_embed = self._pos_embed_cache.get(key)
+        if pos_embed is None:
+            pos_embed = self._pos_embed_cache[key] = get_abs_pos(self.pos_embed, tgt_size)
+        return pos_embed
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = self.patch_embed(x)
         if self.pos_embed is not None:
             # x = x + self.pos_embed
-            x = x + get_abs_pos(self.pos_embed, x.size(1))
+            x = x + self._abs_pos(x.size(1))
 
         for blk in self.blocks:
             x = blk(x)
@@ -233,15 +252,11 @@ class Block(nn.Module):
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         shortcut = x
         x = self.norm1(x)
-        # Window partition
-        if self.window_size > 0:
-            H, W = x.shape[1], x.shape[2]
-            x, pad_hw = window_partition(x, self.window_size)
-
-        x = self.attn(x)
-        # Reverse window partition
         if self.window_size > 0:
-            x = window_unpartition(x, self.window_size, pad_hw, (H, W))
+            # windows are gathered inside the attention, no partition / unpartition copies
+            x = self.attn.forward_windowed(x, self.window_size)
+        else:
+            x = self.attn(x)
 
         x = shortcut + x
         x = x + self.mlp(self.norm2(x))
@@ -288,6 +303,24 @@ class Attention(nn.Module):
             self.rel_pos_h = nn.Parameter(torch.zeros(2 * input_size[0] - 1, head_dim))
             self.rel_pos_w = nn.Parameter(torch.zeros(2 * input_size[1] - 1, head_dim))
 
+        # (q_size, k_size, dtype, device) -> (Rh, Rw) from get_rel_pos
+        self._rel_pos_cache = {}
+
+    def clear_pos_embed_cache(self):
+        """Drop the cached relative position tables; call after rel_pos_h / rel_pos_w change (weight load)."""
+        self._rel_pos_cache.clear()
+
+    def _rel_pos_tables(self, q_size: Tuple[int, int], k_size: Tuple[int, int]) -> Tuple[torch.Tensor, torch.Tensor]:
+        if torch.is_grad_enabled():
+            return (get_rel_pos(q_size[0], k_size[0], self.rel_pos_h),
+                    get_rel_pos(q_size[1], k_size[1], self.rel_pos_w))
+        key = (q_size, k_size, self.rel_pos_h.dtype, self.rel_pos_h.device)
+        tables = self._rel_pos_cache.get(key)
+        if tables is None:
+            tables = self._rel_pos_cache[key] = (get_rel_pos(q_size[0], k_size[0], self.rel_pos_h),
+                                                 get_rel_pos(q_size[1], k_size[1], self.rel_pos_w))
+        return tables
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         B, H, W, _ = x.shape
         # qkv with shape (3, B, nHead, H * W, C)
@@ -295,22 +328,17 @@ class Attention(nn.Module):
         # q, k, v with shape (B * nHead, H * W, C)
         q, k, v = qkv.reshape(3, B * self.num_heads, H * W, -1).unbind(0)
 
-        rel_h, rel_w = None, None
         if self.use_rel_pos:
-            rel_h, rel_w = add_decomposed_rel_pos(q, self.rel_pos_h, self.rel_pos_w, (H, W), (H, W))
+            # the bias is folded into q and k, so no [B, nHead, H * W, H * W] bias is built
+            Rh, Rw = self._rel_pos_tables((H, W), (H, W))
+            q, k = fold_decomposed_rel_pos(q, k, Rh, Rw, (H, W), (H, W), self.scale)
 
         q = q.view(B, self.num_heads, H * W, -1)
         k = k.view(B, self.num_heads, H * W, -1)
         v = v.view(B, self.num_heads, H * W, -1)
 
-        if self.use_rel_pos:
-            rel_h = rel_h.view(B, self.num_heads, rel_h.size(1), rel_h.size(2), rel_h.size(3))
-            rel_w = rel_w.view(B, self.num_heads, rel_w.size(1), rel_w.size(2), rel_w.size(3))
-            attn_bias = (rel_h + rel_w).view(B, self.num_heads, rel_h.size(2), rel_h.size(3) * rel_w.size(4))
-            x = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias)
-            # x = _attention_rel_h_rel_w(q, k, v, rel_h, rel_w)
-        else:
-            x = torch.nn.functional.scaled_dot_product_attention(q, k, v)
+        # explicit scale: with rel pos folded in, q has more channels than head_dim
+        x = torch.nn.functional.scaled_dot_product_attention(q, k, v, scale=self.scale)
             # qkv = torch.stack([q, k, v], dim=1).transpose(1, 3).reshape(B, H * W, 3, self.num_heads, -1)
             # x = flash_attn_qkvpacked_func(qkv, dropout_p=0.0, causal=False).transpose(1, 2)
 
@@ -322,6 +350,70 @@ class Attention(nn.Module):
 
         return x
 
+    def forward_windowed(self, x: torch.Tensor, window_size: int) -> torch.Tensor:
+        """
+        Same result as window_partition -> forward -> window_unpartition on [B, H, W, C].
+
+        qkv is projected on the unpadded tokens and gathered into window order with one
+        index_select; padding tokens get the qkv bias, which is what the zero-padded input
+        produces, so they take part in attention exactly as before. The output is gathered
+        back to [B, H * W] before the projection, so padding is never projected.
+        """
+        B, H, W, C = x.shape
+        gather_idx, pad_pos, inverse_idx = window_indices(H, W, window_size, x.device)
+        num_windows = gather_idx.numel() // (window_size * window_size)
+        L = window_size * window_size
+
+        qkv = self.qkv(x).view(B, H * W, -1)
+        qkv = qkv.index_select(1, gather_idx)
+        if pad_pos.numel():
+            qkv[:, pad_pos] = self.qkv.bias if self.qkv.bias is not None else 0
+        # q, k, v with shape (B * num_windows, nHead, window_size * window_size, C)
+        q, k, v = qkv.view(B * num_windows, L, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4).unbind(0)
+
+        if self.use_rel_pos:
+            # windows are small: the dense [window_size**2, window_size**2] bias is cheap
+            Rh, Rw = self._rel_pos_tables((window_size, window_size), (window_size, window_size))
+            rel_h, rel_w = decomposed_rel_pos(q.reshape(B * num_windows * self.num_heads, L, -1), Rh, Rw,
+                                              (window_size, window_size), (window_size, window_size))
+            rel_h = rel_h.view(B * num_windows, self.num_heads, L, window_size, 1)
+            rel_w = rel_w.view(B * num_windows, self.num_heads, L, 1, window_size)
+            attn_bias = (rel_h + rel_w).view(B * num_windows, self.num_heads, L, L)
+            x = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias)
+        else:
+            x = torch.nn.functional.scaled_dot_product_attention(q, k, v)
+
+        x = x.permute(0, 2, 1, 3).reshape(B, num_windows * L, C)
+        x = x.index_select(1, inverse_idx).view(B, H, W, C)
+
+        return self.proj(x)
+
+
+@lru_cache(maxsize=None)
+def window_indices(H: int, W: int, window_size: int, device: torch.device) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Index tables that replace window_partition / window_unpartition for an H x W grid.
+
+    Returns:
+        gather_idx: [num_windows * window_size**2] token (row-major in H x W) at each
+            window position, in window_partition order; 0 for padding positions.
+        pad_pos: window positions that are padding.
+        inverse_idx: [H * W] window position of each token.
+    """
+    Hp = H + (window_size - H % window_size) % window_size
+    Wp = W + (window_size - W % window_size) % window_size
+    rows = torch.arange(Hp).view(Hp // window_size, 1, window_size, 1)
+    cols = torch.arange(Wp).view(1, Wp // window_size, 1, window_size)
+    rows, cols = torch.broadcast_tensors(rows, cols)
+    rows, cols = rows.reshape(-1), cols.reshape(-1)
+    valid = (rows < H) & (cols < W)
+
+    gather_idx = torch.where(valid, rows * W + cols, torch.zeros_like(rows))
+    pad_pos = torch.nonzero(~valid).flatten()
+    inverse_idx = torch.empty(H * W, dtype=torch.long)
+    inverse_idx[gather_idx[valid]] = torch.nonzero(valid).flatten()
+    return gather_idx.to(device), pad_pos.to(device), inverse_idx.to(device)
+
 
 def window_partition(x: torch.Tensor, window_size: int) -> Tuple[torch.Tensor, Tuple[int, int]]:
     """
@@ -399,12 +491,78 @@ def get_rel_pos(q_size: int, k_size: int, rel_pos: torch.Tensor) -> torch.Tensor
     else:
         rel_pos_resized = rel_pos
 
+    return rel_pos_resized[rel_pos_index(q_size, k_size, rel_pos.device)]
+
+
+@lru_cache(maxsize=None)
+def rel_pos_index(q_size: int, k_size: int, device: torch.device) -> torch.Tensor:
+    """[q_size, k_size] index into the (resized) relative position table; depends on sizes only."""
     # Scale the coords with short length if shapes for q and k are different.
-    q_coords = torch.arange(q_size, device=rel_pos.device)[:, None] * max(k_size / q_size, 1.0)
-    k_coords = torch.arange(k_size, device=rel_pos.device)[None, :] * max(q_size / k_size, 1.0)
+    q_coords = torch.arange(q_size, device=device)[:, None] * max(k_size / q_size, 1.0)
+    k_coords = torch.arange(k_size, device=device)[None, :] * max(q_size / k_size, 1.0)
     relative_coords = (q_coords - k_coords) + (k_size - 1) * max(q_size / k_size, 1.0)
+    return relative_coords.long()
+
+
+@lru_cache(maxsize=None)
+def key_position_one_hot(k_h: int, k_w: int, dtype: torch.dtype, device: torch.device) -> torch.Tensor:
+    """[k_h * k_w, k_h + k_w]: one-hot row then one-hot column of each key position."""
+    positions = torch.arange(k_h * k_w, device=device)
+    one_hot = torch.zeros(k_h * k_w, k_h + k_w, dtype=dtype, device=device)
+    one_hot[positions, positions // k_w] = 1
+    one_hot[positions, k_h + positions % k_w] = 1
+    return one_hot
+
+
+def decomposed_rel_pos(
+    q: torch.Tensor,
+    Rh: torch.Tensor,
+    Rw: torch.Tensor,
+    q_size: Tuple[int, int],
+    k_size: Tuple[int, int],
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    rel_h [B, q_h * q_w, k_h, 1] and rel_w [B, q_h * q_w, 1, k_w] for q (B, q_h * q_w, C),
+    given the Rh / Rw tables from get_rel_pos; their broadcast sum is the attention bias.
+    """
+    q_h, q_w = q_size
+    k_h, k_w = k_size
+
+    B, _, dim = q.shape
+    r_q = q.reshape(B, q_h, q_w, dim)
+    rel_h = torch.einsum("bhwc,hkc->bhwk", r_q, Rh)
+    rel_w = torch.einsum("bhwc,wkc->bhwk", r_q, Rw)
+    rel_h = rel_h.unsqueeze(-1)
+    rel_w = rel_w.unsqueeze(-2)
+    rel_h = rel_h.reshape(B, q_h * q_w, k_h, 1)
+    rel_w = rel_w.reshape(B, q_h * q_w, 1, k_w)
+
+    return rel_h, rel_w
+
+
+def fold_decomposed_rel_pos(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    Rh: torch.Tensor,
+    Rw: torch.Tensor,
+    q_size: Tuple[int, int],
+    k_size: Tuple[int, int],
+    scale: float,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Append the decomposed relative position terms to q and k (both (B, L, C)).
 
-    return rel_pos_resized[relative_coords.long()]
+    q gets rel_h / scale and rel_w / scale as extra channels, k gets the one-hot row
+    and column of each key, so scale * q' @ k'^T = scale * q @ k^T + rel_h + rel_w:
+    attention with the returned q' and k' (and the original scale) equals attention
+    with the dense bias, without building the [q_h * q_w, k_h * k_w] bias.
+    """
+    k_h, k_w = k_size
+    rel_h, rel_w = decomposed_rel_pos(q, Rh, Rw, q_size, k_size)
+    B, L, _ = q.shape
+    q = torch.cat([q, rel_h.view(B, L, k_h) / scale, rel_w.view(B, L, k_w) / scale], dim=-1)
+    k = torch.cat([k, key_position_one_hot(k_h, k_w, k.dtype, k.device).expand(B, -1, -1)], dim=-1)
+    return q, k
 
 
 def add_decomposed_rel_pos(
@@ -427,21 +585,9 @@ def add_decomposed_rel_pos(
     Returns:
         attn (Tensor): attention map with added relative positional embeddings.
     """
-    q_h, q_w = q_size
-    k_h, k_w = k_size
-    Rh = get_rel_pos(q_h, k_h, rel_pos_h)
-    Rw = get_rel_pos(q_w, k_w, rel_pos_w)
-
-    B, _, dim = q.shape
-    r_q = q.reshape(B, q_h, q_w, dim)
-    rel_h = torch.einsum("bhwc,hkc->bhwk", r_q, Rh)
-    rel_w = torch.einsum("bhwc,wkc->bhwk", r_q, Rw)
-    rel_h = rel_h.unsqueeze(-1)
-    rel_w = rel_w.unsqueeze(-2)
-    rel_h = rel_h.reshape(B, q_h * q_w, k_h, 1)
-    rel_w = rel_w.reshape(B, q_h * q_w, 1, k_w)
-
-    return rel_h, rel_w
+    Rh = get_rel_pos(q_size[0], k_size[0], rel_pos_h)
+    Rw = get_rel_pos(q_size[1], k_size[1], rel_pos_w)
+    return decomposed_rel_pos(q, Rh, Rw, q_size, k_size)
 
 
 class PatchEmbed(nn.Module):
@@ -1,6 +1,5 @@
 
 """Inference-only Deepseek-OCR model compatible with HuggingFace weights."""
-import math
 from collections.abc import Iterable, Mapping, Sequence
 from typing import List, Literal, Optional, Set, Tuple, TypedDict, Union
 
@@ -28,7 +27,7 @@ from vllm.transformers_utils.configs.deepseek_vl2 import (DeepseekVLV2Config,
                                                           MlpProjectorConfig,
                                                           VisionEncoderConfig)
 from process.image_process import (
-    DeepseekOCRProcessor, count_tiles)
+    DeepseekOCRProcessor, count_tiles, get_shared_processor)
 from vllm.transformers_utils.tokenizer import cached_tokenizer_from_config
 # from vllm.utils import is_list_of
 
@@ -42,7 +41,9 @@ from deepencoder.clip_sdpa import build_clip_l
 from deepencoder.build_linear import MlpProjector
 from addict import Dict
 # import time
-from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, PRINT_NUM_VIS_TOKENS, PROMPT
+from process.ngram_norepeat import NO_REPEAT_NGRAM_ARG, batched_no_repeat_ngram
+from process.vision_cache import vision_embedding_cache
+from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, PRINT_NUM_VIS_TOKENS, PROMPT, VISION_BATCH_SIZE
 # The image token id may be various
 _IMAGE_TOKEN = "<image>"
 
@@ -63,17 +64,7 @@ class DeepseekOCRProcessingInfo(BaseProcessingInfo):
                              image_width: int,
                              image_height: int,
                              cropping: bool = True) -> int:
-        hf_processor = self.get_hf_processor()
-
-
-        # image_size = hf_processor.image_size
-        # patch_size = hf_processor.patch_size
-        # downsample_ratio = hf_processor.downsample_ratio
-
-        image_size = IMAGE_SIZE
-        base_size = BASE_SIZE
-        patch_size = 16
-        downsample_ratio = 4
+        hf_processor = get_shared_processor()
 
         if CROP_MODE:
             if image_width <= 640 and image_height <= 640:
@@ -92,18 +83,8 @@ class DeepseekOCRProcessingInfo(BaseProcessingInfo):
         else:
             num_width_tiles = num_height_tiles = 1
 
-        h = w = math.ceil((base_size // patch_size) / downsample_ratio)
-
-        h2 = w2 = math.ceil((image_size // patch_size) / downsample_ratio)
-
-        global_views_tokens = h * (w + 1)
-        if num_width_tiles >1 or num_height_tiles>1:
-            local_views_tokens = (num_height_tiles * h2) * (num_width_tiles * w2 + 1)
-        else:
-            local_views_tokens = 0
-
-
-        return global_views_tokens + local_views_tokens + 1
+        # same count the processor uses to lay out the image tokens
+        return hf_processor.image_token_count(num_width_tiles, num_height_tiles)
 
     def get_image_size_with_most_features(self) -> ImageSize:
 
@@ -135,7 +116,7 @@ class DeepseekOCRDummyInputsBuilder(
         if '<image>' in PROMPT:
             return {
                 "image":
-                DeepseekOCRProcessor().tokenize_with_images(images = self._get_dummy_images(width=max_image_size.width,
+                get_shared_processor().tokenize_with_images(images = self._get_dummy_images(width=max_image_size.width,
                                     height=max_image_size.height,
                                     num_images=num_images), bos=True, eos=True, cropping=CROP_MODE)
             }
@@ -185,6 +166,7 @@ class DeepseekOCRMultiModalProcessor(
             images_spatial_crop=MultiModalFieldConfig.batched("image"),
             # image_embeds=MultiModalFieldConfig.batched("image2"),
             images_crop=MultiModalFieldConfig.batched("image"),
+            image_hash=MultiModalFieldConfig.batched("image"),
         )
 
     def _get_prompt_updates(
@@ -254,6 +236,12 @@ class DeepseekOCRMultiModalProcessor(
         )
 
 
+def _spatial_crop_is_placeholder(images_spatial_crop) -> bool:
+    if isinstance(images_spatial_crop, torch.Tensor):
+        return images_spatial_crop.shape[-1] != 2
+    return all(crop.shape[-1] != 2 for crop in images_spatial_crop)
+
+
 @MULTIMODAL_REGISTRY.register_processor(
     DeepseekOCRMultiModalProcessor,
     info=DeepseekOCRProcessingInfo,
@@ -336,9 +324,12 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         pixel_values = kwargs.pop("pixel_values", None)
         images_spatial_crop = kwargs.pop("images_spatial_crop", None)
         images_crop = kwargs.pop("images_crop", None)
+        image_hash = kwargs.pop("image_hash", None)
 
 
-        if pixel_values is None or torch.sum(pixel_values).item() == 0:
+        # a prompt tokenized without images carries an all-zero placeholder whose
+        # images_spatial_crop has no [num_tiles_w, num_tiles_h] pair; checked on shapes only
+        if pixel_values is None or _spatial_crop_is_placeholder(images_spatial_crop):
             return None
 
         if pixel_values is not None:
@@ -354,80 +345,109 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
                 raise ValueError("Incorrect type of image crop. "
                                  f"Got type: {type(images_crop)}")
 
-            return [pixel_values, images_crop, images_spatial_crop]
+            return [pixel_values, images_crop, images_spatial_crop, image_hash]
 
 
         raise AssertionError("This line should be unreachable.")
     
 
 
+    def _encode_views(self, views: torch.Tensor) -> torch.Tensor:
+        """
+        SAM + CLIP + projector over a stack of same-size views [B, 3, H, W].
+
+        Views are run VISION_BATCH_SIZE at a time, so one launch covers the views
+        of many images while activation memory stays bounded.
+        """
+        features = []
+        for chunk in views.split(VISION_BATCH_SIZE):
+            features_1 = self.sam_model(chunk)
+            features_2 = self.vision_model(chunk, features_1)
+            chunk_features = torch.cat((features_2[:, 1:], features_1.flatten(2).permute(0, 2, 1)), dim=-1)
+            features.append(self.projector(chunk_features))
+        return torch.cat(features, dim=0)
+
     def _pixel_values_to_embedding(
         self,
         pixel_values: torch.Tensor,
         images_crop: torch.Tensor,
         images_spatial_crop: torch.Tensor,
+        image_hash: Optional[torch.Tensor] = None,
     ) -> NestedTensors:
 
         # Pixel_values (global view): [n_image, batch_size, 3, height, width]
         # images_spatial_crop: [n_image, batch_size, [num_tiles_w, num_tiles_h]]
-        # images_crop (local view): [n_image, batch_size, num_pathes, 3, h, w]
+        # images_crop (local view): [n_image, batch_size, num_tiles_h, num_tiles_w, 3, h, w]
         # split the pixel and image_crop, all batch_size = 1
+        #
+        # The tile grid is read from the shape of images_crop (a 1x1 grid is the all-zero
+        # placeholder of an image without local views), so nothing here waits on the device.
+        #
+        # The global views of all images go through the encoders as one batch and the
+        # local tiles of all images as another; the features are then split per image.
+        #
+        # With the vision embedding cache on, images whose content hash (and tile grid)
+        # was seen before take their embedding from the cache and skip the encoders.
+
+        num_images = images_spatial_crop.size(0)
+        images_in_this_batch = [None] * num_images
+        cache_keys = [None] * num_images
+        if vision_embedding_cache.enabled and image_hash is not None:
+            # the only device->host read here, made once per batch and only with the cache on
+            hashes = torch.cat([item.flatten() for item in image_hash]).tolist()
+            for jdx, content_hash in enumerate(hashes):
+                if content_hash:
+                    cache_keys[jdx] = (content_hash, tuple(images_crop[jdx][0].shape[:2]))
+                    images_in_this_batch[jdx] = vision_embedding_cache.get(cache_keys[jdx])
+        to_encode = [jdx for jdx in range(num_images) if images_in_this_batch[jdx] is None]
+        if not to_encode:
+            return images_in_this_batch
 
-        images_in_this_batch = []
-
-
-        # print(type(images_crop))
+        with torch.no_grad():
+            patches_per_image = {}
+            for jdx in to_encode:
+                patches = images_crop[jdx][0] # batch_size = 1
+                height_crop_num, width_crop_num = patches.shape[:2]
+                if height_crop_num * width_crop_num > 1:
+                    patches_per_image[jdx] = patches.flatten(0, 1).to(torch.bfloat16)
+                else:
+                    patches_per_image[jdx] = None
 
-        # print(pixel_values.shape)
+            global_features_all = self._encode_views(torch.cat([pixel_values[jdx] for jdx in to_encode], dim=0))
 
+            local_patches = [patches_per_image[jdx] for jdx in to_encode if patches_per_image[jdx] is not None]
+            local_features_iter = iter(())
+            if local_patches:
+                local_features_iter = iter(self._encode_views(torch.cat(local_patches, dim=0)).split(
+                    [patches.size(0) for patches in local_patches]))
 
-        with torch.no_grad():
-            for jdx in range(images_spatial_crop.size(0)):
-                # with torch.set_grad_enabled(False):
-                patches = images_crop[jdx][0].to(torch.bfloat16) # batch_size = 1
-                image_ori = pixel_values[jdx]
-                crop_shape = images_spatial_crop[jdx][0]
+            for position, jdx in enumerate(to_encode):
+                global_features = global_features_all[position]
 
-                if torch.sum(patches).item() != 0:  # if all values = 0, no crop
-                    # P, C, H, W = patches.shape
-                    # crop_flag = 1
-                    local_features_1 = self.sam_model(patches)
-                    #TODO del patches 
-                    # torch.compiler.cudagraph_mark_step_begin()
-                    local_features_2 = self.vision_model(patches, local_features_1)  
+                _, n_dim = global_features.shape
+                h = w = int(global_features.size(0) ** 0.5)
 
+                global_features = global_features.view(h, w, n_dim)
 
-                    local_features = torch.cat((local_features_2[:, 1:], local_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    local_features = self.projector(local_features)
+                global_features = torch.cat(
+                    [global_features, self.image_newline[None, None, :].expand(h, 1, n_dim)], dim=1
+                )
 
+                global_features = global_features.view(-1, n_dim)
 
-                    global_features_1 = self.sam_model(image_ori)
-                    global_features_2 = self.vision_model(image_ori, global_features_1) 
-                    global_features = torch.cat((global_features_2[:, 1:], global_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    global_features = self.projector(global_features)
+                if patches_per_image[jdx] is not None:
+                    local_features = next(local_features_iter)
 
                     if PRINT_NUM_VIS_TOKENS:
                         print('=====================')
-                        print('BASE: ', global_features.shape)
+                        print('BASE: ', global_features_all[position:position + 1].shape)
                         print('PATCHES: ', local_features.shape)
                         print('=====================')
 
-                    _, hw, n_dim = global_features.shape
-                    h = w = int(hw ** 0.5)
-
                     _2, hw2, n_dim2 = local_features.shape
                     h2 = w2 = int(hw2 ** 0.5)
 
-                    width_crop_num, height_crop_num = crop_shape[0], crop_shape[1]
-
-                    global_features = global_features.view(h, w, n_dim)
-
-                    global_features = torch.cat(
-                        [global_features, self.image_newline[None, None, :].expand(h, 1, n_dim)], dim=1
-                    )
-
-                    global_features = global_features.view(-1, n_dim)
-
+                    height_crop_num, width_crop_num = images_crop[jdx][0].shape[:2]
 
                     local_features = local_features.view(height_crop_num, width_crop_num, h2, w2, n_dim2).permute(0, 2, 1, 3, 4).reshape(height_crop_num*h2, width_crop_num*w2, n_dim2)
                     local_features = torch.cat(
@@ -436,33 +456,19 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
                     local_features = local_features.view(-1, n_dim2)
 
                     global_local_features = torch.cat([local_features, global_features, self.view_seperator[None, :]], dim=0)
-                
-                else:
-                    global_features_1 = self.sam_model(image_ori)
-                    global_features_2 = self.vision_model(image_ori, global_features_1) 
-                    global_features = torch.cat((global_features_2[:, 1:], global_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    global_features = self.projector(global_features)
 
+                else:
                     if PRINT_NUM_VIS_TOKENS:
                         print('=====================')
-                        print('BASE: ', global_features.shape)
+                        print('BASE: ', global_features_all[position:position + 1].shape)
                         print('NO PATCHES')
                         print('=====================')
 
-                    _, hw, n_dim = global_features.shape
-                    h = w = int(hw ** 0.5)
-
-                    global_features = global_features.view(h, w, n_dim)
-
-                    global_features = torch.cat(
-                        [global_features, self.image_newline[None, None, :].expand(h, 1, n_dim)], dim=1
-                    )
-
-                    global_features = global_features.view(-1, n_dim)
-
                     global_local_features = torch.cat([global_features, self.view_seperator[None, :]], dim=0)
 
-                images_in_this_batch.append(global_local_features)
+                images_in_this_batch[jdx] = global_local_features
+                if cache_keys[jdx] is not None:
+                    vision_embedding_cache.put(cache_keys[jdx], global_local_features)
 
         return images_in_this_batch
 
@@ -470,7 +476,7 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
             self, image_input) -> torch.Tensor:
         
 
-        # image_input: [pixel_values, images_crop, images_spatial_crop]
+        # image_input: [pixel_values, images_crop, images_spatial_crop, image_hash]
     
         pixel_values = image_input[0].to(torch.bfloat16)
         # print(image_input[1][0].shape)
@@ -484,7 +490,8 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
 
         # local_start = time.time()
         vision_features = self._pixel_values_to_embedding(
-            pixel_values=pixel_values, images_crop = images_crop,  images_spatial_crop=images_spatial_crop)
+            pixel_values=pixel_values, images_crop = images_crop,  images_spatial_crop=images_spatial_crop,
+            image_hash=image_input[3])
 
         # local_total_time = time.time() - local_start
 
@@ -557,8 +564,32 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         hidden_states: torch.Tensor,
         sampling_metadata: SamplingMetadata,
     ) -> Optional[torch.Tensor]:
-        return self.language_model.compute_logits(hidden_states,
-                                                  sampling_metadata)
+        logits = self.language_model.compute_logits(hidden_states,
+                                                    sampling_metadata)
+        if logits is not None and sampling_metadata is not None and sampling_metadata.seq_groups is not None:
+            logits = self._apply_no_repeat_ngram(logits, sampling_metadata)
+        return logits
+
+    def _apply_no_repeat_ngram(self, logits: torch.Tensor, sampling_metadata: SamplingMetadata) -> torch.Tensor:
+        # sequences that asked for the n-gram ban through SamplingParams.extra_args
+        # (no_repeat_ngram_args), grouped by settings and banned one group at a time
+        groups = {}
+        for seq_group in sampling_metadata.seq_groups:
+            extra_args = seq_group.sampling_params.extra_args
+            if not extra_args or NO_REPEAT_NGRAM_ARG not in extra_args:
+                continue
+            settings = extra_args[NO_REPEAT_NGRAM_ARG]
+            key = (settings['ngram_size'], settings['window_size'], settings['whitelist_token_ids'])
+            rows, token_histories = groups.setdefault(key, ([], []))
+            for seq_id, row in zip(seq_group.seq_ids, seq_group.sample_indices):
+                rows.append(row)
+                # the array itself: output_token_ids would copy the whole history into a tuple
+                token_histories.append(seq_group.seq_data[seq_id].output_token_ids_array)
+
+        for (ngram_size, window_size, whitelist_token_ids), (rows, token_histories) in groups.items():
+            logits = batched_no_repeat_ngram(logits, token_histories, ngram_size, window_size,
+                                             whitelist_token_ids, rows=rows)
+        return logits
 
 
     def load_weights(self, weights: Iterable[Tuple[str, torch.Tensor]]) -> Set[str]:
@@ -575,6 +606,12 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         loader = AutoWeightsLoader(self)
         autoloaded_weights = loader.load_weights(processed_weights, mapper=self.hf_to_vllm_mapper)
 
+        # resized positional embeddings cached by the encoders were built from the old weights
+        for module in self.modules():
+            if hasattr(module, 'clear_pos_embed_cache'):
+                module.clear_pos_embed_cache()
+        vision_embedding_cache.clear()
+
 
 
 
@@ -12,7 +12,7 @@ from gradio_app import (
     process_ocr_image,
     re_match
 )
-from process.image_process import DeepseekOCRProcessor
+from process.image_process import get_shared_processor
 
 
 async def simple_ocr_example(image_path: str, prompt: str = None):
@@ -42,7 +42,7 @@ async def simple_ocr_example(image_path: str, prompt: str = None):
     
     # Process image
     print("Processing image...")
-    image_features = DeepseekOCRProcessor().tokenize_with_images(
+    image_features = get_shared_processor().tokenize_with_images(
         images=[image], bos=True, eos=True, cropping=True
     )
     
@@ -90,7 +90,7 @@ async def batch_ocr_example(image_paths: list, prompt: str = None):
             continue
         
         # Process image
-        image_features = DeepseekOCRProcessor().tokenize_with_images(
+        image_features = get_shared_processor().tokenize_with_images(
             images=[image], bos=True, eos=True, cropping=True
         )
         
@@ -139,7 +139,7 @@ async def custom_prompt_example(image_path: str):
         print(f"Testing prompt: {name}")
         print(f"{'='*50}")
         
-        image_features = DeepseekOCRProcessor().tokenize_with_images(
+        image_features = get_shared_processor().tokenize_with_images(
             images=[image], bos=True, eos=True, cropping=True
         )
         
@@ -1,12 +1,17 @@
 import os
 import re
-import io
 import asyncio
+import queue
+import time
 import zipfile
-from typing import Optional, List, Tuple, Iterator
+import collections
+from typing import Callable, Optional, List, Tuple
 from PIL import Image, ImageOps, ImageDraw, ImageFont
 import numpy as np
 import gradio as gr
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
 import torch
 import fitz  # PyMuPDF
 
@@ -21,15 +26,28 @@ from vllm import AsyncLLMEngine, SamplingParams
 from vllm.engine.arg_utils import AsyncEngineArgs
 from vllm.model_executor.models.registry import ModelRegistry
 from deepseek_ocr import DeepseekOCRForCausalLM
-from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
-from process.image_process import DeepseekOCRProcessor
-from config import MODEL_PATH, IMAGE_SIZE, BASE_SIZE, CROP_MODE
+from process.ngram_norepeat import no_repeat_ngram_args
+from process.image_process import get_shared_processor
+from process.engine_loop import get_engine_loop
+from process.engine_warmup import EngineStatus, warmup_pages
+from process.pdf_render import iter_pdf_images
+from process.pdf_text import PAGE_TEXT, classify_page, format_page_stats, page_to_markdown
+from process.result_cache import OcrResultCache, result_key
+from process.vision_cache import vision_embedding_cache
+from process.page_journal import JournalInUseError, PageJournal, job_fingerprint
+from config import MODEL_PATH, IMAGE_SIZE, BASE_SIZE, CROP_MODE, RENDER_WORKERS, RENDER_DPI_MODE, PDF_TEXT_FAST_PATH, MAX_CONCURRENCY
+from config import RESULT_CACHE_DIR, RESULT_CACHE_MB, GRADIO_CONCURRENCY, ENGINE_WARMUP, WARMUP_GRIDS, PROMPT
 
 # Register the model
 ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
 
-# Global variable to store the engine
+# Global variable to store the engine; it is created and used only on the get_engine_loop() thread
 engine = None
+# load time and warm-up latencies of the engine, served by /health
+engine_status = EngineStatus()
+
+# On-disk OCR results of PDF pages, shared by all requests (None when RESULT_CACHE_DIR is '')
+result_cache = OcrResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MB * 2**20) if RESULT_CACHE_DIR else None
 
 # Global cancellation flag for PDF processing
 pdf_processing_cancelled = False
@@ -264,40 +282,6 @@ def choose_first_valid_image(*sources: Tuple[str, object]) -> Tuple[str, object]
     return "none", None
 
 
-def iter_pdf_images(pdf_path: str, dpi: int = 144, start_page: int = 0, end_page: Optional[int] = None) -> Iterator[Tuple[int, Image.Image]]:
-    """Lazily render PDF pages to PIL images to avoid high RAM usage.
-
-    Yields (page_index, PIL.Image) for each page in [start_page, end_page).
-    """
-    Image.MAX_IMAGE_PIXELS = None
-    doc = fitz.open(pdf_path)
-    try:
-        total = doc.page_count
-        if end_page is None or end_page > total:
-            end_page = total
-
-        start_page = max(0, start_page)
-
-        zoom = dpi / 72.0
-        matrix = fitz.Matrix(zoom, zoom)
-
-        for page_num in range(start_page, end_page):
-            page = doc[page_num]
-            pixmap = page.get_pixmap(matrix=matrix, alpha=False)
-            # Use PNG bytes to leverage libpng compression and reduce peak memory during conversion
-            img_data = pixmap.tobytes("png")
-            img = Image.open(io.BytesIO(img_data))
-            if img.mode in ('RGBA', 'LA'):
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                img = background
-            yield page_num, img
-            # Help GC promptly
-            del pixmap, img_data
-    finally:
-        doc.close()
-
-
 def re_match(text):
     """Extract reference patterns from text"""
     pattern = r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)'
@@ -382,6 +366,7 @@ async def initialize_engine():
     """Initialize the AsyncLLMEngine"""
     global engine
     if engine is None:
+        engine_status.start('loading')
         engine_args = AsyncEngineArgs(
             model=MODEL_PATH,
             hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
@@ -391,11 +376,58 @@ async def initialize_engine():
             trust_remote_code=True,
             tensor_parallel_size=1,
             gpu_memory_utilization=0.75,
+            max_num_seqs=MAX_CONCURRENCY,
         )
-        engine = AsyncLLMEngine.from_engine_args(engine_args)
+        try:
+            engine = AsyncLLMEngine.from_engine_args(engine_args)
+        except Exception as e:
+            engine_status.failed(e)
+            raise
+        engine_status.loaded()
+        if not ENGINE_WARMUP:
+            engine_status.ready()
     return engine
 
 
+async def warm_up_engine():
+    """Load the engine and decode one page per tile grid of WARMUP_GRIDS, timing each page"""
+    try:
+        await initialize_engine()
+        engine_status.start('warming_up')
+        # a few tokens are enough to run the vision encoders, the projector and decoding for each shape
+        sampling_params = pdf_sampling_params()
+        sampling_params.max_tokens = 32
+        for label, page in warmup_pages(WARMUP_GRIDS):
+            request = {
+                "prompt": PROMPT,
+                "multi_modal_data": {"image": get_shared_processor().tokenize_with_images(
+                    images=[page], bos=True, eos=True, cropping=CROP_MODE
+                )}
+            }
+            started = time.perf_counter()
+            async for _ in engine.generate(request, sampling_params, f"warmup-{label}"):
+                pass
+            seconds = time.perf_counter() - started
+            engine_status.warmed_up(label, seconds)
+            print(f"Warm-up {label}: {seconds:.2f}s")
+        engine_status.ready()
+    except Exception as e:
+        engine_status.failed(e)
+        raise
+
+
+def wait_for_engine():
+    """With ENGINE_WARMUP, hold a request until the warm-up has finished (or failed)"""
+    if ENGINE_WARMUP:
+        engine_status.settled.wait()
+
+
+def health():
+    """Readiness probe: 200 once requests are served without waiting for the engine, 503 before"""
+    ready = engine_status.state == 'ready' or (not ENGINE_WARMUP and engine_status.state != 'failed')
+    return JSONResponse(engine_status.as_dict(), status_code=200 if ready else 503)
+
+
 async def generate_ocr_result(image_features, prompt: str, progress=gr.Progress()):
     """Generate OCR result using the model"""
     global engine
@@ -403,14 +435,14 @@ async def generate_ocr_result(image_features, prompt: str, progress=gr.Progress(
     if engine is None:
         await initialize_engine()
     
-    logits_processors = [NoRepeatNGramLogitsProcessor(
+    no_repeat_ngram = no_repeat_ngram_args(
         ngram_size=30, window_size=90, whitelist_token_ids={128821, 128822}
-    )]
+    )
     
     sampling_params = SamplingParams(
         temperature=0.0,
         max_tokens=4096,  # Reduced from 8192 to speed up processing and avoid timeouts
-        logits_processors=logits_processors,
+        extra_args=no_repeat_ngram,
         skip_special_tokens=False,
     )
     
@@ -468,14 +500,16 @@ def process_ocr_image(
     progress(0.2, desc=get_text("processing_image", lang))
     try:
         if '<image>' in prompt_template:
-            image_features = DeepseekOCRProcessor().tokenize_with_images(
+            image_features = get_shared_processor().tokenize_with_images(
                 images=[image], bos=True, eos=True, cropping=use_cropping
             )
         else:
             image_features = ''
         
         progress(0.5, desc=get_text("running_ocr", lang))
-        result_text = asyncio.run(generate_ocr_result(image_features, prompt_template, progress))
+        wait_for_engine()
+        result_text = get_engine_loop().run(generate_ocr_result(image_features, prompt_template, progress))
+        print_cache_stats()
         
         # Process the output
         progress(0.9, desc=get_text("processing_results", lang))
@@ -499,6 +533,176 @@ def process_ocr_image(
         return None, f"{get_text('error_ocr', lang)} {str(e)}", None
 
 
+def text_layer_pages(pdf_path: str, page_indices: List[int], page_stats) -> dict:
+    """Markdown of the text-native pages among page_indices (empty unless PDF_TEXT_FAST_PATH)"""
+    if page_stats is None:
+        return {}
+    page_texts = {}
+    with fitz.open(pdf_path) as doc:
+        for page_idx in page_indices:
+            page_kind = classify_page(doc[page_idx])
+            page_stats[page_kind] += 1
+            if page_kind == PAGE_TEXT:
+                page_texts[page_idx] = page_to_markdown(doc[page_idx])
+    return page_texts
+
+
+def pdf_sampling_params() -> SamplingParams:
+    """Sampling parameters of the PDF path (part of the result cache key)"""
+    no_repeat_ngram = no_repeat_ngram_args(
+        ngram_size=30, window_size=90, whitelist_token_ids={128821, 128822}
+    )
+    return SamplingParams(
+        temperature=0.0,
+        max_tokens=8192,
+        extra_args=no_repeat_ngram,
+        skip_special_tokens=False,
+    )
+
+
+def clean_ocr_text(result_text: str) -> str:
+    """Drop detection tags from the raw model output"""
+    matches_ref, matches_images, matches_other = re_match(result_text)
+    clean_text = result_text
+    for match in matches_images + matches_other:
+        clean_text = clean_text.replace(match, '')
+    return clean_text.replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:')
+
+
+def ocr_pdf_chunk(pdf_path: str, sub_indices: List[int], prompt_template: str, use_cropping: bool, page_stats,
+                  journal: Optional[PageJournal] = None, on_page_done: Optional[Callable[[int], None]] = None) -> dict:
+    """
+    Cleaned text of each page in sub_indices, from the text layer, the journal, the result cache or the engine.
+
+    The engine's pages are submitted together on the engine loop (at most MAX_CONCURRENCY
+    in flight), so they decode in one continuous batch; if one fails, the others are
+    cancelled. Each page is added to `journal` as soon as it finishes, and `on_page_done`
+    is called with the number of pages of the chunk done so far; both happen in the
+    calling thread, so the fsync never stalls the engine loop.
+    """
+    # Born-digital pages are taken from the text layer and not sent to the model
+    page_texts = text_layer_pages(pdf_path, sub_indices, page_stats)
+    sampling_params = pdf_sampling_params()
+    raw_results = {}
+    # Prepare batch inputs
+    batch_inputs = []
+    ocr_indices = []
+    cache_keys = []
+    # Lazily render only the pages in this chunk
+    for page_idx, image in iter_pdf_images(pdf_path, dpi=144, start_page=sub_indices[0], end_page=sub_indices[-1] + 1,
+                                           workers=RENDER_WORKERS, dpi_mode=RENDER_DPI_MODE, cropping=use_cropping):
+        if page_idx in page_texts:
+            continue
+        if journal is not None and page_idx in journal.pages:
+            raw_results[page_idx] = journal.pages[page_idx][0]
+            continue
+        cache_key = None
+        if result_cache is not None:
+            cache_key = result_key(image, prompt_template, sampling_params, use_cropping)
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                raw_results[page_idx] = cached[0]
+                continue
+        if '<image>' in prompt_template:
+            image_features = get_shared_processor().tokenize_with_images(
+                images=[image], bos=True, eos=True, cropping=use_cropping
+            )
+        else:
+            image_features = ''
+
+        request = {
+            "prompt": prompt_template,
+            "multi_modal_data": {"image": image_features} if image_features else {}
+        }
+        ocr_indices.append(page_idx)
+        cache_keys.append(cache_key)
+        batch_inputs.append(request)
+
+    # (page_idx, text, finish_reason) of finished engine pages, passed from the engine loop to this thread
+    finished_pages = queue.Queue()
+
+    # Generate for the batch
+    async def generate_batch():
+        global engine
+        if engine is None:
+            await initialize_engine()
+
+        semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
+        async def generate_page(page_idx, request):
+            async with semaphore:
+                request_id = f"request-{os.urandom(16).hex()}"
+                full_text, finish_reason = "", None
+                async for request_output in engine.generate(request, sampling_params, request_id):
+                    if request_output.outputs:
+                        full_text = request_output.outputs[0].text
+                        finish_reason = request_output.outputs[0].finish_reason
+            finished_pages.put((page_idx, full_text, finish_reason))
+            return full_text, finish_reason
+
+        tasks = [asyncio.ensure_future(generate_page(page_idx, request))
+                 for page_idx, request in zip(ocr_indices, batch_inputs)]
+        try:
+            # gather returns the results in page order, whatever order the pages finish in
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            # cancelling closes the other pages' engine.generate generators, which aborts their requests
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    if batch_inputs:
+        wait_for_engine()
+        batch_future = get_engine_loop().submit(generate_batch())
+        # pages from the text layer, the journal or the cache are done already
+        done = len(sub_indices) - len(batch_inputs)
+        while not batch_future.done() or not finished_pages.empty():
+            try:
+                page_idx, full_text, finish_reason = finished_pages.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if journal is not None:
+                journal.record(page_idx, full_text, finish_reason)
+            done += 1
+            if on_page_done is not None:
+                on_page_done(done)
+        for page_idx, cache_key, (result_text, finish_reason) in zip(ocr_indices, cache_keys, batch_future.result()):
+            raw_results[page_idx] = result_text
+            if cache_key is not None:
+                result_cache.put(cache_key, result_text, finish_reason)
+
+    # Process results
+    for page_idx, result_text in raw_results.items():
+        page_texts[page_idx] = clean_ocr_text(result_text)
+    return page_texts
+
+
+def report_page_progress(progress, chunk_start: int, num_pages: int, lang: str) -> Callable[[int], None]:
+    """Progress callback for ocr_pdf_chunk: `done` pages of the chunk starting at chunk_start are finished"""
+    def on_page_done(done: int):
+        progress((chunk_start + done) / num_pages, desc=f"{get_text('processing_page', lang)} {chunk_start + done}/{num_pages}...")
+    return on_page_done
+
+
+def print_cache_stats():
+    """Log the hit rates of the caches in use; they are process-wide, so the counts cover all requests so far"""
+    if vision_embedding_cache.enabled:
+        print(vision_embedding_cache.format_stats())
+    if result_cache is not None:
+        print(result_cache.format_stats())
+
+
+def finish_journal(journal: Optional[PageJournal], failed_chunks: int):
+    """Delete the journal of a completed job; one with failed chunks is kept so a rerun only redoes those"""
+    if journal is None:
+        return
+    # removed while still locked, so no other request opens it in between
+    if not failed_chunks:
+        os.remove(journal.path)
+    journal.close()
+
+
 def process_ocr_pdf(
     pdf_file,
     prompt_template: str,
@@ -514,6 +718,9 @@ def process_ocr_pdf(
     if pdf_file is None:
         return [], get_text("please_upload_pdf", lang)
     
+    journal = None
+    # the journal is deleted once every page has been OCRed, and kept for a rerun otherwise
+    failed_chunks = 0
     try:
         progress(0.05, desc=get_text("converting_pdf", lang))
 
@@ -529,6 +736,14 @@ def process_ocr_pdf(
 
         os.makedirs("output", exist_ok=True)
         base_name = os.path.splitext(os.path.basename(pdf_file.name))[0]
+        page_stats = collections.Counter() if PDF_TEXT_FAST_PATH else None
+        # pages finished by an earlier, interrupted run of the same job are taken from its journal
+        fingerprint = job_fingerprint(pdf_file.name, prompt_template, pdf_sampling_params(), use_cropping)
+        try:
+            journal = PageJournal(os.path.join("output", "journals", f"{fingerprint}.jsonl"), fingerprint, resume=True)
+        except JournalInUseError:
+            # another request is processing the same PDF with the same prompt; this one runs without a journal
+            journal = None
         
         if num_pages <= 25:
             # Process as single batch
@@ -543,68 +758,18 @@ def process_ocr_pdf(
                 
                 sub_indices = list(range(i, min(i + effective_batch_size, num_pages)))
                 
-                progress((i + len(sub_indices)) / num_pages, desc=f"{get_text('processing_page', lang)} {i + 1}-{min(i + effective_batch_size, num_pages)}/{num_pages}...")
+                progress(i / num_pages, desc=f"{get_text('processing_page', lang)} {i + 1}-{min(i + effective_batch_size, num_pages)}/{num_pages}...")
                 
                 try:
-                    # Prepare batch inputs
-                    batch_inputs = []
-                    # Lazily render only the pages in this chunk
-                    sub_images = []
-                    for page_idx, image in iter_pdf_images(pdf_file.name, dpi=144, start_page=sub_indices[0], end_page=sub_indices[-1] + 1):
-                        sub_images.append(image)
-                        if '<image>' in prompt_template:
-                            image_features = DeepseekOCRProcessor().tokenize_with_images(
-                                images=[image], bos=True, eos=True, cropping=use_cropping
-                            )
-                        else:
-                            image_features = ''
-                        
-                        request = {
-                            "prompt": prompt_template,
-                            "multi_modal_data": {"image": image_features} if image_features else {}
-                        }
-                        batch_inputs.append(request)
-                    
-                    # Generate for the batch
-                    async def generate_batch():
-                        global engine
-                        if engine is None:
-                            await initialize_engine()
-                        
-                        logits_processors = [NoRepeatNGramLogitsProcessor(
-                            ngram_size=30, window_size=90, whitelist_token_ids={128821, 128822}
-                        )]
-                        
-                        sampling_params = SamplingParams(
-                            temperature=0.0,
-                            max_tokens=8192,
-                            logits_processors=logits_processors,
-                            skip_special_tokens=False,
-                        )
-                        
-                        results = []
-                        for request in batch_inputs:
-                            request_id = f"request-{os.urandom(16).hex()}"
-                            full_text = ""
-                            async for request_output in engine.generate(request, sampling_params, request_id):
-                                if request_output.outputs:
-                                    full_text = request_output.outputs[0].text
-                            results.append(full_text)
-                        return results
-                    
-                    batch_results = asyncio.run(generate_batch())
-                    
-                    # Process results
-                    for idx_offset, (result_text, global_idx) in enumerate(zip(batch_results, sub_indices)):
-                        matches_ref, matches_images, matches_other = re_match(result_text)
-                        clean_text = result_text
-                        for match in matches_images + matches_other:
-                            clean_text = clean_text.replace(match, '')
-                        clean_text = clean_text.replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:')
-                        
+                    # text layer, result cache or the engine, per page
+                    page_texts = ocr_pdf_chunk(pdf_file.name, sub_indices, prompt_template, use_cropping, page_stats, journal,
+                                               report_page_progress(progress, i, num_pages, lang))
+
+                    for global_idx in sub_indices:
+                        clean_text = page_texts[global_idx]
                         all_results.append(f"--- Page {global_idx + 1} ---\n{clean_text}\n")
                     # Help GC between chunks
-                    del sub_images, batch_inputs, batch_results
+                    del page_texts
                     import gc
                     gc.collect()
                         
@@ -613,9 +778,14 @@ def process_ocr_pdf(
                         error_msg = f"--- Page {global_idx + 1} ---\nError processing page: {str(batch_error)}\n"
                         all_results.append(error_msg)
                     print(f"Error on batch {i//effective_batch_size + 1}: {batch_error}")
+                    failed_chunks += 1
                     # Continue processing other batches
             
+            if page_stats is not None:
+                print(f"{base_name}: {format_page_stats(page_stats, num_pages)}")
+            print_cache_stats()
             progress(1.0, desc=get_text("complete", lang))
+            finish_journal(journal, failed_chunks)
             return [], "\n".join(all_results)
         
         else:
@@ -630,66 +800,16 @@ def process_ocr_pdf(
                 
                 sub_indices = list(range(i, min(i + batch_size, num_pages)))
                 
-                progress((i + len(sub_indices)) / num_pages, desc=f"{get_text('processing_page', lang)} {i + 1}-{min(i + batch_size, num_pages)}/{num_pages}...")
+                progress(i / num_pages, desc=f"{get_text('processing_page', lang)} {i + 1}-{min(i + batch_size, num_pages)}/{num_pages}...")
                 
                 try:
-                    # Prepare batch inputs
-                    batch_inputs = []
-                    # Lazily render only the pages in this chunk
-                    sub_images = []
-                    for page_idx, image in iter_pdf_images(pdf_file.name, dpi=144, start_page=sub_indices[0], end_page=sub_indices[-1] + 1):
-                        sub_images.append(image)
-                        if '<image>' in prompt_template:
-                            image_features = DeepseekOCRProcessor().tokenize_with_images(
-                                images=[image], bos=True, eos=True, cropping=use_cropping
-                            )
-                        else:
-                            image_features = ''
-                        
-                        request = {
-                            "prompt": prompt_template,
-                            "multi_modal_data": {"image": image_features} if image_features else {}
-                        }
-                        batch_inputs.append(request)
-                    
-                    # Generate for the batch
-                    async def generate_batch():
-                        global engine
-                        if engine is None:
-                            await initialize_engine()
-                        
-                        logits_processors = [NoRepeatNGramLogitsProcessor(
-                            ngram_size=30, window_size=90, whitelist_token_ids={128821, 128822}
-                        )]
-                        
-                        sampling_params = SamplingParams(
-                            temperature=0.0,
-                            max_tokens=8192,
-                            logits_processors=logits_processors,
-                            skip_special_tokens=False,
-                        )
-                        
-                        results = []
-                        for request in batch_inputs:
-                            request_id = f"request-{os.urandom(16).hex()}"
-                            full_text = ""
-                            async for request_output in engine.generate(request, sampling_params, request_id):
-                                if request_output.outputs:
-                                    full_text = request_output.outputs[0].text
-                            results.append(full_text)
-                        return results
-                    
-                    batch_results = asyncio.run(generate_batch())
-                    
-                    # Process results
+                    # text layer, result cache or the engine, per page
+                    page_texts = ocr_pdf_chunk(pdf_file.name, sub_indices, prompt_template, use_cropping, page_stats, journal,
+                                               report_page_progress(progress, i, num_pages, lang))
                     batch_texts = []
-                    for idx_offset, (result_text, global_idx) in enumerate(zip(batch_results, sub_indices)):
-                        matches_ref, matches_images, matches_other = re_match(result_text)
-                        clean_text = result_text
-                        for match in matches_images + matches_other:
-                            clean_text = clean_text.replace(match, '')
-                        clean_text = clean_text.replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:')
-                        
+
+                    for global_idx in sub_indices:
+                        clean_text = page_texts[global_idx]
                         batch_texts.append(f"--- Page {global_idx + 1} ---\n{clean_text}\n")
                     
                     # Save to file
@@ -698,7 +818,7 @@ def process_ocr_pdf(
                         f.write("\n\n".join(batch_texts))
                     file_paths.append(file_path)
                     # Help GC between chunks
-                    del sub_images, batch_inputs, batch_results, batch_texts
+                    del page_texts, batch_texts
                     import gc
                     gc.collect()
                     
@@ -709,14 +829,22 @@ def process_ocr_pdf(
                         f.write(error_content)
                     file_paths.append(error_file_path)
                     print(f"Error on batch {i//batch_size + 1}: {batch_error}")
+                    failed_chunks += 1
                     # Continue processing other batches
             
+            if page_stats is not None:
+                print(f"{base_name}: {format_page_stats(page_stats, num_pages)}")
+            print_cache_stats()
             progress(1.0, desc=get_text("complete", lang))
+            finish_journal(journal, failed_chunks)
             return file_paths, ""
         
     except Exception as e:
         progress(1.0, desc="Error occurred")
         return [], f"{get_text('error_pdf', lang)} {str(e)}"
+    finally:
+        if journal is not None:
+            journal.close()
 
 
 def load_file_content(file_path):
@@ -1126,14 +1254,17 @@ if __name__ == "__main__":
     print(f"Image Size: {IMAGE_SIZE}, Base Size: {BASE_SIZE}")
     print(f"Crop Mode: {CROP_MODE}")
     
-    # Initialize the engine in the background
-    print("\nStarting engine initialization...")
-    
     app = create_gradio_app()
-    app.queue()
-    app.launch(
-        server_name="localhost",
-        server_port=7860,
-        share=False,
-        show_error=True
-    )
+    app.queue(default_concurrency_limit=GRADIO_CONCURRENCY)
+
+    if ENGINE_WARMUP:
+        # Initialize the engine in the background; OCR requests wait for it and /health reports progress
+        print("\nStarting engine initialization...")
+        get_engine_loop().submit(warm_up_engine())
+
+    server = FastAPI()
+    server.add_api_route("/health", health, methods=["GET"])
+    # launch() sets this; mounting the app on our own server skips launch()
+    app.show_error = True
+    server = gr.mount_gradio_app(server, app, path="/")
+    uvicorn.run(server, host="localhost", port=7860)
@@ -0,0 +1,51 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Coroutine
+
+
+class EngineLoop:
+    """
+    One asyncio event loop running in a daemon thread for the life of the process.
+
+    AsyncLLMEngine ties its background step loop to the event loop it is first used
+    from, so every coroutine touching the engine has to run on the same loop. submit()
+    can be called from any thread (e.g. concurrent Gradio handlers); their requests
+    overlap on this loop and the engine batches them together.
+    """
+
+    def __init__(self, name: str = 'engine-loop'):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def submit(self, coro: Coroutine) -> Future:
+        """Schedule coro on the loop; returns a concurrent.futures.Future of its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def run(self, coro: Coroutine) -> Any:
+        """submit() and wait for the result in the calling thread."""
+        return self.submit(coro).result()
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+_engine_loop = None
+_engine_loop_lock = threading.Lock()
+
+
+def get_engine_loop() -> EngineLoop:
+    """Process-wide EngineLoop, started on first use."""
+    global _engine_loop
+    if _engine_loop is None:
+        with _engine_loop_lock:
+            if _engine_loop is None:
+                _engine_loop = EngineLoop()
+    return _engine_loop
@@ -0,0 +1,87 @@
+import threading
+import time
+from typing import List, Optional, Sequence, Tuple
+
+from PIL import Image, ImageDraw, ImageFont
+
+from config import CROP_MODE, IMAGE_SIZE, MAX_CROPS, MIN_CROPS
+from process.image_process import get_tile_planner
+
+
+# label of the page that is only encoded as a global view (no local tiles)
+UNTILED = 'untiled'
+
+
+def _warmup_page(width: int, height: int) -> Image.Image:
+    # a few lines of text, so the engine decodes some tokens instead of stopping at once
+    page = Image.new('RGB', (width, height), (255, 255, 255))
+    draw = ImageDraw.Draw(page)
+    font = ImageFont.load_default()
+    for line in range(0, min(height, 400), 40):
+        draw.text((40, 40 + line), 'DeepSeek-OCR warm-up page', font=font, fill=(0, 0, 0))
+    return page
+
+
+def warmup_pages(grids: Optional[Sequence[str]] = None, cropping: bool = CROP_MODE) -> List[Tuple[str, Image.Image]]:
+    """
+    One page per tile grid the planner can pick, as (label, page) pairs.
+
+    Labels are 'WxH' (num_width_tiles x num_height_tiles) and UNTILED for a page
+    small enough to be encoded as the global view only; each page is sized so the
+    planner picks exactly its grid. `grids` keeps only the listed labels (None: all).
+    """
+    pages = [(UNTILED, _warmup_page(IMAGE_SIZE, IMAGE_SIZE))]
+    if cropping:
+        planner = get_tile_planner(MIN_CROPS, MAX_CROPS, IMAGE_SIZE)
+        for num_width_tiles, num_height_tiles in planner.target_ratios:
+            size = (num_width_tiles * IMAGE_SIZE, num_height_tiles * IMAGE_SIZE)
+            if planner.grid(*size) == (num_width_tiles, num_height_tiles):
+                pages.append((f'{num_width_tiles}x{num_height_tiles}', _warmup_page(*size)))
+    if grids is not None:
+        pages = [(label, page) for label, page in pages if label in grids]
+    return pages
+
+
+class EngineStatus:
+    """
+    Load and warm-up progress of the engine, as reported by the health endpoint.
+
+    state goes not_loaded -> loading -> warming_up -> ready, or to failed; `settled`
+    is set once it reaches ready or failed.
+    """
+
+    def __init__(self):
+        self.state = 'not_loaded'
+        self.load_seconds = None
+        # (label, seconds) per warm-up page, in the order they ran
+        self.warmup_seconds = []
+        self.error = None
+        self.settled = threading.Event()
+        self._started = None
+
+    def start(self, state: str):
+        self.state = state
+        self._started = time.perf_counter()
+
+    def loaded(self):
+        self.load_seconds = time.perf_counter() - self._started
+
+    def warmed_up(self, label: str, seconds: float):
+        self.warmup_seconds.append((label, seconds))
+
+    def ready(self):
+        self.state = 'ready'
+        self.settled.set()
+
+    def failed(self, error: BaseException):
+        self.state = 'failed'
+        self.error = repr(error)
+        self.settled.set()
+
+    def as_dict(self) -> dict:
+        return {
+            'state': self.state,
+            'load_seconds': self.load_seconds,
+            'warmup_seconds': dict(self.warmup_seconds),
+            'error': self.error,
+        }
@@ -1,12 +1,18 @@
+import bisect
+import functools
 import math
+import threading
 from typing import List, Tuple
 
+import numpy as np
 import torch
+import torch.nn.functional as F
 import torchvision.transforms as T
 from PIL import Image, ImageOps
 from transformers import AutoProcessor, BatchFeature, LlamaTokenizerFast
 from transformers.processing_utils import ProcessorMixin
-from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, MIN_CROPS, MAX_CROPS, PROMPT, TOKENIZER
+from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, MIN_CROPS, MAX_CROPS, PROMPT, TOKENIZER, TENSOR_PREPROCESS, VISION_CACHE_MB
+from process.vision_cache import image_content_hash
 
 def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
     best_ratio_diff = float('inf')
@@ -25,37 +31,77 @@ def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_
     return best_ratio
 
 
-def count_tiles(orig_width, orig_height, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, use_thumbnail=False):
-    aspect_ratio = orig_width / orig_height
+class TileGridPlanner:
+    """
+    Precomputed tile-grid selection for one (min_num, max_num, image_size).
+
+    Candidate grids are built once and indexed by aspect ratio, so finding the
+    grid for an image is a binary search instead of a scan. The result is the
+    same as find_closest_aspect_ratio over the sorted target ratios, including
+    its tie-breaking on image area.
+    """
+
+    def __init__(self, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640):
+        self.min_num = min_num
+        self.max_num = max_num
+        self.image_size = image_size
+
+        target_ratios = set(
+            (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
+            i * j <= max_num and i * j >= min_num)
+        self.target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
+
+        # aspect value -> [(scan order, ratio)], scan order is the position in target_ratios
+        groups = {}
+        for order, ratio in enumerate(self.target_ratios):
+            groups.setdefault(ratio[0] / ratio[1], []).append((order, ratio))
+        self._aspects = sorted(groups)
+        self._groups = [groups[aspect] for aspect in self._aspects]
+
+    def grid(self, width, height):
+        """Return the (num_width_tiles, num_height_tiles) grid for an image of the given size."""
+        aspect_ratio = width / height
+
+        best_ratio_diff = float('inf')
+        candidates = []
+        pos = bisect.bisect_left(self._aspects, aspect_ratio)
+        for k in (pos - 1, pos):
+            if 0 <= k < len(self._aspects):
+                ratio_diff = abs(aspect_ratio - self._aspects[k])
+                if ratio_diff < best_ratio_diff:
+                    best_ratio_diff = ratio_diff
+                    candidates = list(self._groups[k])
+                elif ratio_diff == best_ratio_diff:
+                    candidates += self._groups[k]
+        if not candidates:
+            return (1, 1)
+
+        # equally close grids are visited in scan order, as find_closest_aspect_ratio does
+        candidates.sort()
+        area = width * height
+        best_ratio = candidates[0][1]
+        for _, ratio in candidates[1:]:
+            if area > 0.5 * self.image_size * self.image_size * ratio[0] * ratio[1]:
+                best_ratio = ratio
+        return best_ratio
 
-    # calculate the existing image aspect ratio
-    target_ratios = set(
-        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
-        i * j <= max_num and i * j >= min_num)
-    # print(target_ratios)
-    target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
 
-    # find the closest aspect ratio to the target
-    target_aspect_ratio = find_closest_aspect_ratio(
-        aspect_ratio, target_ratios, orig_width, orig_height, image_size)
+@functools.lru_cache(maxsize=None)
+def get_tile_planner(min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640) -> TileGridPlanner:
+    """Shared TileGridPlanner per (min_num, max_num, image_size)."""
+    return TileGridPlanner(min_num=min_num, max_num=max_num, image_size=image_size)
+
 
-    return target_aspect_ratio
+def count_tiles(orig_width, orig_height, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, use_thumbnail=False):
+    return get_tile_planner(min_num, max_num, image_size).grid(orig_width, orig_height)
 
 
 def dynamic_preprocess(image, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, use_thumbnail=False):
     orig_width, orig_height = image.size
-    aspect_ratio = orig_width / orig_height
-
-    # calculate the existing image aspect ratio
-    target_ratios = set(
-        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
-        i * j <= max_num and i * j >= min_num)
-    # print(target_ratios)
-    target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
 
     # find the closest aspect ratio to the target
-    target_aspect_ratio = find_closest_aspect_ratio(
-        aspect_ratio, target_ratios, orig_width, orig_height, image_size)
+    target_aspect_ratio = count_tiles(orig_width, orig_height, min_num=min_num, max_num=max_num,
+                                      image_size=image_size)
 
     # print(target_aspect_ratio)
     # calculate the target width and height
@@ -83,8 +129,72 @@ def dynamic_preprocess(image, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=6
     return processed_images, target_aspect_ratio
 
 
+def pil_to_uint8_tensor(image: Image.Image) -> torch.Tensor:
+    """Convert a PIL image to a [3, H, W] uint8 tensor with a single copy."""
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return torch.from_numpy(np.array(image, dtype=np.uint8)).permute(2, 0, 1)
 
 
+def resize_uint8(x: torch.Tensor, size: Tuple[int, int]) -> torch.Tensor:
+    """
+    Bicubic antialiased resize of a [3, H, W] uint8 tensor to size=(width, height).
+    Matches PIL's default BICUBIC resize to within 2/255 per pixel.
+    """
+    width, height = size
+    if x.shape[-1] == width and x.shape[-2] == height:
+        return x
+    return F.interpolate(x[None], size=(height, width), mode='bicubic',
+                         antialias=True, align_corners=False)[0]
+
+
+def pad_uint8(x: torch.Tensor, size: Tuple[int, int], color: Tuple[int, int, int]) -> torch.Tensor:
+    """Tensor counterpart of ImageOps.pad: fit x inside size=(width, height), keep aspect, center."""
+    height, width = x.shape[-2:]
+    im_ratio = width / height
+    dest_ratio = size[0] / size[1]
+    new_size = size
+    if im_ratio != dest_ratio:
+        if im_ratio > dest_ratio:
+            new_height = round(height / width * size[0])
+            if new_height != size[1]:
+                new_size = (size[0], new_height)
+        else:
+            new_width = round(width / height * size[1])
+            if new_width != size[0]:
+                new_size = (new_width, size[1])
+    resized = resize_uint8(x, new_size)
+    if new_size == size:
+        return resized
+
+    out = torch.tensor(color, dtype=torch.uint8)[:, None, None].repeat(1, size[1], size[0])
+    if new_size[0] != size[0]:
+        left = round((size[0] - new_size[0]) * 0.5)
+        out[:, :, left:left + new_size[0]] = resized
+    else:
+        top = round((size[1] - new_size[1]) * 0.5)
+        out[:, top:top + new_size[1], :] = resized
+    return out
+
+
+def dynamic_preprocess_tensor(x: torch.Tensor, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640):
+    """
+    Tensor counterpart of dynamic_preprocess.
+
+    Resizes the [3, H, W] uint8 page once and returns the tiles as a
+    [num_tiles, 3, image_size, image_size] uint8 tensor (row-major, same order
+    as dynamic_preprocess) built from a strided view of the resized page.
+    """
+    orig_height, orig_width = x.shape[-2:]
+    target_aspect_ratio = count_tiles(orig_width, orig_height, min_num=min_num, max_num=max_num,
+                                      image_size=image_size)
+    num_width_tiles, num_height_tiles = target_aspect_ratio
+
+    resized = resize_uint8(x, (image_size * num_width_tiles, image_size * num_height_tiles))
+    tiles = resized.view(3, num_height_tiles, image_size, num_width_tiles, image_size)
+    tiles = tiles.permute(1, 3, 0, 2, 4).reshape(-1, 3, image_size, image_size)
+    return tiles, target_aspect_ratio
+
 
 class ImageTransform:
 
@@ -107,6 +217,15 @@ class ImageTransform:
         x = self.transform(pil_img)
         return x
 
+    def from_uint8(self, x: torch.Tensor) -> torch.Tensor:
+        """Batched ToTensor + Normalize for [..., 3, H, W] uint8 tensors; same arithmetic as __call__."""
+        x = x.to(torch.float32).div_(255)
+        if self.normalize:
+            mean = torch.tensor(self.mean, dtype=x.dtype)[:, None, None]
+            std = torch.tensor(self.std, dtype=x.dtype)[:, None, None]
+            x = x.sub_(mean).div_(std)
+        return x
+
 
 class DeepseekOCRProcessor(ProcessorMixin):
     tokenizer_class = ("LlamaTokenizer", "LlamaTokenizerFast")
@@ -142,6 +261,7 @@ class DeepseekOCRProcessor(ProcessorMixin):
         self.downsample_ratio = 4
 
         self.image_transform = ImageTransform(mean=image_mean, std=image_std, normalize=normalize)
+        self.tensor_preprocess = TENSOR_PREPROCESS
 
 
         self.tokenizer = tokenizer
@@ -181,6 +301,13 @@ class DeepseekOCRProcessor(ProcessorMixin):
         self.mask_prompt = mask_prompt
         self.ignore_id = ignore_id
 
+        # the prompt is fixed (config.PROMPT), so its text pieces are tokenized once here;
+        # tokenize_with_images then never touches the shared tokenizer
+        self.prompt_split_ids = tuple(
+            tuple(self.encode(text_sep, bos=False, eos=False)) for text_sep in PROMPT.split(image_token))
+        self.pad_color = tuple(int(x * 255) for x in self.image_transform.mean)
+        self._token_templates = {}
+
         super().__init__(
             tokenizer,
             **kwargs,
@@ -269,7 +396,7 @@ class DeepseekOCRProcessor(ProcessorMixin):
 
         sft_format = prompt
 
-        input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, _ = images[0]
+        input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, image_hash, _ = images[0]
 
 
         return {
@@ -279,6 +406,7 @@ class DeepseekOCRProcessor(ProcessorMixin):
             "images_seq_mask": images_seq_mask,
             "images_spatial_crop": images_spatial_crop,
             "num_image_tokens": num_image_tokens,
+            "image_hash": image_hash,
         }
 
 
@@ -327,6 +455,97 @@ class DeepseekOCRProcessor(ProcessorMixin):
 
         return prepare
 
+    def preprocess_tensor(self, image: Image.Image, cropping: bool = True):
+        """
+        Tensor-native counterpart of the PIL global/local view preprocessing.
+
+        The page is converted to a uint8 tensor once; resizing, padding and tiling
+        happen on that tensor and normalization runs once per view batch, so no
+        per-tile PIL crop or per-tile transform is needed. Output differs from the
+        PIL path only through resampling (at most 2/255 per pixel before
+        normalization); pixels that are not resampled are bit-identical.
+
+        Returns:
+            global_view (torch.FloatTensor): [3, base_size, base_size]
+            local_views (torch.FloatTensor or None): [num_tiles, 3, image_size, image_size]
+            crop_ratio (Tuple[int, int]): (num_width_tiles, num_height_tiles)
+        """
+        x = pil_to_uint8_tensor(image)
+
+        local_views = None
+        crop_ratio = (1, 1)
+        if cropping and (image.size[0] > 640 or image.size[1] > 640):
+            tiles, crop_ratio = dynamic_preprocess_tensor(x, image_size=IMAGE_SIZE)
+            if crop_ratio[0] > 1 or crop_ratio[1] > 1:
+                local_views = self.image_transform.from_uint8(tiles)
+
+        if self.image_size <= 640 and not cropping:
+            x = resize_uint8(x, (self.image_size, self.image_size))
+
+        global_view = pad_uint8(x, (self.base_size, self.base_size), color=self.pad_color)
+        global_view = self.image_transform.from_uint8(global_view)
+
+        return global_view, local_views, crop_ratio
+
+    def image_token_count(self, num_width_tiles: int, num_height_tiles: int) -> int:
+        """Number of <image> tokens for one image with the given tile grid."""
+        num_queries = math.ceil((self.image_size // self.patch_size) / self.downsample_ratio)
+        num_queries_base = math.ceil((self.base_size // self.patch_size) / self.downsample_ratio)
+
+        # global view rows (each with a newline token) + view separator
+        count = (num_queries_base + 1) * num_queries_base + 1
+        if num_width_tiles > 1 or num_height_tiles > 1:
+            count += (num_queries * num_width_tiles + 1) * (num_queries * num_height_tiles)
+        return count
+
+    def token_template(self, crop_ratios: Tuple[Tuple[int, int], ...], bos: bool = True, eos: bool = True):
+        """
+        Token layout of the fixed prompt with one image per entry of crop_ratios.
+
+        The layout only depends on (base_size, image_size, tile grids), so it is
+        built once per key and cached. The returned tensors are shared between
+        calls and must not be modified in place.
+
+        Returns:
+            input_ids (torch.LongTensor): [1, N + image tokens], ending eos removed
+            images_seq_mask (torch.BoolTensor): [N + image tokens]
+            num_image_tokens (Tuple[int]): image tokens per image
+        """
+        key = (self.base_size, self.image_size, crop_ratios, bos, eos)
+        template = self._token_templates.get(key)
+        if template is not None:
+            return template
+
+        assert len(crop_ratios) == len(self.prompt_split_ids) - 1
+        id_pieces, mask_pieces, num_image_tokens = [], [], []
+        if bos:
+            id_pieces.append(torch.tensor([self.bos_id], dtype=torch.long))
+            mask_pieces.append(torch.zeros(1, dtype=torch.bool))
+        for tokenized_sep, (num_width_tiles, num_height_tiles) in zip(self.prompt_split_ids, crop_ratios):
+            id_pieces.append(torch.tensor(tokenized_sep, dtype=torch.long))
+            mask_pieces.append(torch.zeros(len(tokenized_sep), dtype=torch.bool))
+            count = self.image_token_count(num_width_tiles, num_height_tiles)
+            id_pieces.append(torch.full((count,), self.image_token_id, dtype=torch.long))
+            mask_pieces.append(torch.ones(count, dtype=torch.bool))
+            num_image_tokens.append(count)
+        id_pieces.append(torch.tensor(self.prompt_split_ids[-1], dtype=torch.long))
+        mask_pieces.append(torch.zeros(len(self.prompt_split_ids[-1]), dtype=torch.bool))
+        if eos:
+            id_pieces.append(torch.tensor([self.eos_id], dtype=torch.long))
+            mask_pieces.append(torch.zeros(1, dtype=torch.bool))
+
+        input_ids = torch.cat(id_pieces)
+        images_seq_mask = torch.cat(mask_pieces)
+
+        # inference mode: remove the ending eos token
+        assert input_ids[-1] == self.eos_id
+        input_ids = input_ids[:-1].unsqueeze(0)
+        images_seq_mask = images_seq_mask[:-1]
+
+        template = (input_ids, images_seq_mask, tuple(num_image_tokens))
+        self._token_templates[key] = template
+        return template
+
     def tokenize_with_images(
         self,
         # conversation: str,
@@ -340,18 +559,10 @@ class DeepseekOCRProcessor(ProcessorMixin):
         # print(conversation)
         conversation = PROMPT
         assert conversation.count(self.image_token) == len(images)
-        text_splits = conversation.split(self.image_token)
-        images_list, images_crop_list, images_seq_mask, images_spatial_crop = [], [], [], []
-        image_shapes = []
-        num_image_tokens = []
-        tokenized_str = []
+        images_list, images_crop_list, images_spatial_crop = [], [], []
+        image_shapes, image_hashes = [], []
         # print('image: ', len(images))
-        for text_sep, image in zip(text_splits, images):
-            """encode text_sep"""
-            tokenized_sep = self.encode(text_sep, bos=False, eos=False)
-            tokenized_str += tokenized_sep
-            images_seq_mask += [False] * len(tokenized_sep)
-
+        for image in images:
             """select best resolution for anyres"""
             # if cropping:
             #     best_width, best_height = self.select_best_resolution(image.size)
@@ -359,52 +570,63 @@ class DeepseekOCRProcessor(ProcessorMixin):
             #     best_width, best_height = self.image_size, self.image_size
 
             image_shapes.append(image.size)
-
-            if image.size[0] <= 640 and image.size[1] <= 640:
-                crop_ratio = [1, 1]
+            # key of the model's vision embedding cache; 0 (not hashed) while the cache is off
+            image_hashes.append(image_content_hash(image, self.base_size, self.image_size, cropping, self.tensor_preprocess,
+                                                   MIN_CROPS, MAX_CROPS) if VISION_CACHE_MB else 0)
+
+            if self.tensor_preprocess:
+                global_view, local_views, crop_ratio = self.preprocess_tensor(image, cropping)
+                images_list.append(global_view)
+                num_width_tiles, num_height_tiles = crop_ratio
+                images_spatial_crop.append([num_width_tiles, num_height_tiles])
+                if local_views is not None:
+                    images_crop_list.append(local_views.view(num_height_tiles, num_width_tiles, *local_views.shape[1:]))
             else:
-                if cropping:
-                    # print('image-size: ', image.size)
-                    # best_width, best_height = select_best_resolution(image.size, self.candidate_resolutions)
-                    # print('image ', image.size)
-                    # print('open_size:', image.size)
-                    images_crop_raw, crop_ratio = dynamic_preprocess(image, image_size=IMAGE_SIZE)
-                    # print('crop_ratio: ', crop_ratio)
-                else:
-                    # best_width, best_height = self.image_size, self.image_size
+                if image.size[0] <= 640 and image.size[1] <= 640:
                     crop_ratio = [1, 1]
-            # print(image.size, (best_width, best_height)) # check the select_best_resolutions func
-
-            # print(crop_ratio)
-            """process the global view"""
-
-            # if cropping
-            if self.image_size <= 640 and not cropping:
-                # print('directly resize')
-                image = image.resize((self.image_size, self.image_size))
-
-            global_view = ImageOps.pad(image, (self.base_size, self.base_size),
-                                    color=tuple(int(x * 255) for x in self.image_transform.mean))
-            images_list.append(self.image_transform(global_view))
-
-            """record height / width crop num"""
-            # width_crop_num, height_crop_num = best_width // self.image_size, best_height // self.image_size
-            num_width_tiles, num_height_tiles = crop_ratio
-            images_spatial_crop.append([num_width_tiles, num_height_tiles])
-
-
-
-
-            if num_width_tiles > 1 or num_height_tiles > 1:
-                """process the local views"""
-                # local_view = ImageOps.pad(image, (best_width, best_height),
-                #                         color=tuple(int(x * 255) for x in self.image_transform.mean))
-                # for i in range(0, best_height, self.image_size):
-                #     for j in range(0, best_width, self.image_size):
-                #         images_crop_list.append(
-                #             self.image_transform(local_view.crop((j, i, j + self.image_size, i + self.image_size))))
-                for i in range(len(images_crop_raw)):
-                    images_crop_list.append(self.image_transform(images_crop_raw[i]))
+                else:
+                    if cropping:
+                        # print('image-size: ', image.size)
+                        # best_width, best_height = select_best_resolution(image.size, self.candidate_resolutions)
+                        # print('image ', image.size)
+                        # print('open_size:', image.size)
+                        images_crop_raw, crop_ratio = dynamic_preprocess(image, image_size=IMAGE_SIZE)
+                        # print('crop_ratio: ', crop_ratio)
+                    else:
+                        # best_width, best_height = self.image_size, self.image_size
+                        crop_ratio = [1, 1]
+                # print(image.size, (best_width, best_height)) # check the select_best_resolutions func
+
+                # print(crop_ratio)
+                """process the global view"""
+
+                # if cropping
+                if self.image_size <= 640 and not cropping:
+                    # print('directly resize')
+                    image = image.resize((self.image_size, self.image_size))
+
+                global_view = ImageOps.pad(image, (self.base_size, self.base_size), color=self.pad_color)
+                images_list.append(self.image_transform(global_view))
+
+                """record height / width crop num"""
+                # width_crop_num, height_crop_num = best_width // self.image_size, best_height // self.image_size
+                num_width_tiles, num_height_tiles = crop_ratio
+                images_spatial_crop.append([num_width_tiles, num_height_tiles])
+
+
+
+
+                if num_width_tiles > 1 or num_height_tiles > 1:
+                    """process the local views"""
+                    # local_view = ImageOps.pad(image, (best_width, best_height),
+                    #                         color=tuple(int(x * 255) for x in self.image_transform.mean))
+                    # for i in range(0, best_height, self.image_size):
+                    #     for j in range(0, best_width, self.image_size):
+                    #         images_crop_list.append(
+                    #             self.image_transform(local_view.crop((j, i, j + self.image_size, i + self.image_size))))
+                    images_crop_list.append(torch.stack(
+                        [self.image_transform(images_crop_raw[i]) for i in range(len(images_crop_raw))], dim=0
+                    ).view(num_height_tiles, num_width_tiles, 3, self.image_size, self.image_size))
 
             # """process the global view"""
             # global_view = ImageOps.pad(image, (self.image_size, self.image_size),
@@ -419,84 +641,52 @@ class DeepseekOCRProcessor(ProcessorMixin):
             #         images_list.append(
             #             self.image_transform(local_view.crop((j, i, j + self.image_size, i + self.image_size))))
 
-            # """add image tokens"""
-            """add image tokens"""
-            num_queries = math.ceil((self.image_size // self.patch_size) / self.downsample_ratio)
-            num_queries_base = math.ceil((self.base_size // self.patch_size) / self.downsample_ratio)
 
-
-            tokenized_image = ([self.image_token_id] * num_queries_base + [self.image_token_id]) * num_queries_base
-            tokenized_image += [self.image_token_id]
-            if num_width_tiles > 1 or num_height_tiles > 1:
-                tokenized_image += ([self.image_token_id] * (num_queries * num_width_tiles) + [self.image_token_id]) * (
-                            num_queries * num_height_tiles)
-            tokenized_str += tokenized_image
-            images_seq_mask += [True] * len(tokenized_image)
-            num_image_tokens.append(len(tokenized_image))
-
-        """process the last text split"""
-        tokenized_sep = self.encode(text_splits[-1], bos=False, eos=False)
-        tokenized_str += tokenized_sep
-        images_seq_mask += [False] * len(tokenized_sep)
-
-        """add the bos and eos tokens"""
-        if bos:
-            tokenized_str = [self.bos_id] + tokenized_str
-            images_seq_mask = [False] + images_seq_mask
-        if eos:
-            tokenized_str = tokenized_str + [self.eos_id]
-            images_seq_mask = images_seq_mask + [False]
-
-        assert len(tokenized_str) == len(
-            images_seq_mask), f"tokenize_with_images func: tokenized_str's length {len(tokenized_str)} is not equal to imags_seq_mask's length {len(images_seq_mask)}"
-        
-
-
-        masked_tokenized_str = []
-        for token_index in tokenized_str:
-            if token_index != self.image_token_id:
-                masked_tokenized_str.append(token_index)
-            else:
-                masked_tokenized_str.append(self.ignore_id)
-
-        assert len(tokenized_str) == len(images_seq_mask) == len(masked_tokenized_str), \
-            (f"tokenized_str's length {len(tokenized_str)}, input_ids' length {len(masked_tokenized_str)}, "
-             f"imags_seq_mask's length {len(images_seq_mask)}, are not equal")
-
-        input_ids = torch.LongTensor(tokenized_str)
-        target_ids = torch.LongTensor(masked_tokenized_str)
-        images_seq_mask = torch.tensor(images_seq_mask, dtype=torch.bool)
-
-        # set input_ids < 0 | input_ids == self.image_token_id as ignore_id
-        target_ids[(input_ids < 0) |
-                   (input_ids == self.image_token_id)] = self.ignore_id
-        input_ids[input_ids < 0] = self.pad_id
-
-        inference_mode = True
-
-        if inference_mode:
-            # Remove the ending eos token
-            assert input_ids[-1] == self.eos_id
-            input_ids = input_ids[:-1]
-            target_ids = target_ids[:-1]
-            images_seq_mask = images_seq_mask[:-1]
+        """add the prompt and image tokens"""
+        input_ids, images_seq_mask, num_image_tokens = self.token_template(
+            tuple(tuple(crop) for crop in images_spatial_crop), bos=bos, eos=eos)
+        input_ids = input_ids.clone()
+        images_seq_mask = images_seq_mask.clone()
+        num_image_tokens = list(num_image_tokens)
 
         if len(images_list) == 0:
             pixel_values = torch.zeros((1, 3, self.base_size, self.base_size))
             images_spatial_crop = torch.zeros((1, 1), dtype=torch.long)
-            images_crop = torch.zeros((1, 3, self.image_size, self.image_size)).unsqueeze(0)
+            images_crop = torch.zeros((1, 1, 3, self.image_size, self.image_size)).unsqueeze(0)
         else:
             pixel_values = torch.stack(images_list, dim=0)
             images_spatial_crop = torch.tensor(images_spatial_crop, dtype=torch.long)
             if images_crop_list:
-                images_crop = torch.stack(images_crop_list, dim=0).unsqueeze(0)
+                images_crop = torch.cat(images_crop_list, dim=0).unsqueeze(0)
             else:
-                images_crop = torch.zeros((1, 3, self.image_size, self.image_size)).unsqueeze(0)
-
-        input_ids = input_ids.unsqueeze(0)
-
-        
-        return [[input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, image_shapes]]
+                images_crop = torch.zeros((1, 1, 3, self.image_size, self.image_size)).unsqueeze(0)
+
+        # images_crop: [1, num_height_tiles, num_width_tiles, 3, image_size, image_size], a single
+        # all-zero tile when there are no local views; the model reads the tile grid from this
+        # shape, so it needs no device->host copy of images_spatial_crop
+        image_hash = torch.tensor(image_hashes or [0], dtype=torch.long)
+        return [[input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, image_hash,
+                 image_shapes]]
+
+
+_shared_processor = None
+_shared_processor_lock = threading.Lock()
+
+
+def get_shared_processor() -> DeepseekOCRProcessor:
+    """
+    Process-wide DeepseekOCRProcessor, constructed once.
+
+    Construction configures the global TOKENIZER (padding side, pad token), so it
+    is done under a lock; afterwards tokenize_with_images only reads precomputed
+    state and is safe to call from many preprocessing threads.
+    """
+    global _shared_processor
+    if _shared_processor is None:
+        with _shared_processor_lock:
+            if _shared_processor is None:
+                _shared_processor = DeepseekOCRProcessor()
+    return _shared_processor
 
 
 AutoProcessor.register("DeepseekVLV2Processor", DeepseekOCRProcessor)
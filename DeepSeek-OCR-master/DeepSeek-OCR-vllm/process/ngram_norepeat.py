@@ -1,40 +1,218 @@
+import collections
+import numpy as np
 import torch
 from transformers import LogitsProcessor
 from transformers.generation.logits_process import _calc_banned_ngram_tokens
-from typing import List, Set
+from typing import List, Optional, Sequence, Set
+
+
+# SamplingParams.extra_args key read by DeepseekOCRForCausalLM.compute_logits
+NO_REPEAT_NGRAM_ARG = 'no_repeat_ngram'
+# finish reason reported for outputs stopped by RepetitionDetector
+REPETITION_FINISH_REASON = 'repetition'
+
+_HASH_MOD = (1 << 61) - 1
+_HASH_BASE = 1_000_003
+
+
+def _check_sizes(ngram_size, window_size):
+    if not isinstance(ngram_size, int) or ngram_size <= 0:
+        raise ValueError(f"`ngram_size` has to be a strictly positive integer, but is {ngram_size}")
+    if not isinstance(window_size, int) or window_size <= 0:
+        raise ValueError(f"`window_size` has to be a strictly positive integer, but is {window_size}")
 
 
 class NoRepeatNGramLogitsProcessor(LogitsProcessor):
+    """
+    Bans every token that would repeat an n-gram starting in the last `window_size`
+    generated tokens (whitelisted tokens excepted).
+
+    vLLM calls the processor with the generated ids of one sequence and its logits row.
+    The n-grams in the window are kept in an index from the rolling hash of their
+    first ngram_size - 1 tokens to their start positions, and each call only adds the
+    tokens generated since the previous one. vLLM gives every request its own copy
+    through clone(); if the ids do not continue the indexed sequence (an instance
+    shared between sequences), the index is rebuilt from the window, so the bans are
+    always those of a full scan of the window.
+    """
 
     def __init__(self, ngram_size: int, window_size: int = 100, whitelist_token_ids: set = None):
-        if not isinstance(ngram_size, int) or ngram_size <= 0:
-            raise ValueError(f"`ngram_size` has to be a strictly positive integer, but is {ngram_size}")
-        if not isinstance(window_size, int) or window_size <= 0:
-            raise ValueError(f"`window_size` has to be a strictly positive integer, but is {window_size}")
+        _check_sizes(ngram_size, window_size)
         self.ngram_size = ngram_size
         self.window_size = window_size
         self.whitelist_token_ids = whitelist_token_ids or set()
-    
+        self._prefix_size = ngram_size - 1
+        # weight of the token leaving the prefix hash
+        self._out_weight = pow(_HASH_BASE, max(self._prefix_size - 1, 0), _HASH_MOD)
+        self._reset([])
+
+    def clone(self) -> "NoRepeatNGramLogitsProcessor":
+        """Fresh instance with the same settings; used by SamplingParams.clone per request."""
+        return NoRepeatNGramLogitsProcessor(self.ngram_size, self.window_size, self.whitelist_token_ids)
+
+    def _reset(self, tokens: List[int]):
+        self._tokens = tokens
+        # the rolling hash covers tokens from here on
+        self._hash_start = len(tokens)
+        # hash of the last prefix_size tokens
+        self._prefix_hash = 0
+        # (start, prefix hash) of the indexed n-grams, oldest first
+        self._ngrams = collections.deque()
+        # prefix hash -> start positions of the n-grams with that prefix, oldest first
+        self._index = {}
+
+    def _append(self, token: int):
+        pos = len(self._tokens)
+        out_pos = pos - self._prefix_size
+        prefix_hash = self._prefix_hash
+        if out_pos >= self._hash_start:
+            # the prefix ending before `token` is complete: the n-gram starting at out_pos ends with `token`
+            self._ngrams.append((out_pos, prefix_hash))
+            self._index.setdefault(prefix_hash, collections.deque()).append(out_pos)
+            prefix_hash -= self._tokens[out_pos] * self._out_weight
+        self._prefix_hash = (prefix_hash * _HASH_BASE + token) % _HASH_MOD
+        self._tokens.append(token)
+
+    def _sync(self, input_ids: List[int]):
+        num_indexed = len(self._tokens)
+        # bans only depend on the window and the prefix, so only those tokens have to match
+        check_from = max(0, num_indexed - max(self.window_size, self._prefix_size))
+        if len(input_ids) < num_indexed or list(input_ids[check_from:num_indexed]) != self._tokens[check_from:]:
+            num_indexed = max(0, len(input_ids) - self.window_size - self._prefix_size)
+            self._reset(list(input_ids[:num_indexed]))
+        for token in input_ids[num_indexed:]:
+            self._append(token)
+
+        window_start = len(self._tokens) - self.window_size
+        while self._ngrams and self._ngrams[0][0] < window_start:
+            _, prefix_hash = self._ngrams.popleft()
+            starts = self._index[prefix_hash]
+            starts.popleft()
+            if not starts:
+                del self._index[prefix_hash]
+
     def __call__(self, input_ids: List[int], scores: torch.FloatTensor) -> torch.FloatTensor:
-        if len(input_ids) < self.ngram_size:
+        # an empty prefix never matched the previous tuple comparison, so unigrams ban nothing
+        if len(input_ids) < self.ngram_size or self.ngram_size == 1:
             return scores
-        
-        current_prefix = tuple(input_ids[-(self.ngram_size - 1):])
-        
-        search_start = max(0, len(input_ids) - self.window_size)
-        search_end = len(input_ids) - self.ngram_size + 1
-        
-        banned_tokens = set()
-        for i in range(search_start, search_end):
-            ngram = tuple(input_ids[i:i + self.ngram_size])
-            if ngram[:-1] == current_prefix:
-                banned_tokens.add(ngram[-1])
-        
+
+        self._sync(input_ids)
+
+        starts = self._index.get(self._prefix_hash)
+        if not starts:
+            return scores
+
+        tokens, prefix_size = self._tokens, self._prefix_size
+        current_prefix = tokens[-prefix_size:]
+        # hash hits are confirmed against the tokens, so collisions cannot ban anything
+        banned_tokens = {tokens[start + prefix_size] for start in starts
+                         if tokens[start:start + prefix_size] == current_prefix}
         banned_tokens = banned_tokens - self.whitelist_token_ids
-        
+
         if banned_tokens:
-            scores = scores.clone()
-            for token in banned_tokens:
-                scores[token] = -float("inf")
-        
-        return scores
\ No newline at end of file
+            # in place: vLLM writes the returned row back into the logits it was taken from
+            scores[torch.tensor(list(banned_tokens), device=scores.device)] = -float("inf")
+
+        return scores
+
+
+def no_repeat_ngram_args(ngram_size: int, window_size: int = 100, whitelist_token_ids: set = None) -> dict:
+    """
+    SamplingParams(extra_args=...) asking for the n-gram ban of NoRepeatNGramLogitsProcessor;
+    the model applies it to all running sequences at once (batched_no_repeat_ngram)
+    instead of vLLM calling a processor once per sequence.
+    """
+    _check_sizes(ngram_size, window_size)
+    return {NO_REPEAT_NGRAM_ARG: {
+        'ngram_size': ngram_size,
+        'window_size': window_size,
+        'whitelist_token_ids': frozenset(whitelist_token_ids or ()),
+    }}
+
+
+def batched_no_repeat_ngram(scores: torch.FloatTensor, token_histories: Sequence[Sequence[int]],
+                            ngram_size: int, window_size: int = 100, whitelist_token_ids: set = None,
+                            rows: Optional[Sequence[int]] = None) -> torch.FloatTensor:
+    """
+    The bans of NoRepeatNGramLogitsProcessor for many sequences in one pass.
+
+    token_histories[i] holds the generated ids of the sequence in row rows[i] of
+    scores [num_rows, vocab] (rows defaults to 0..len - 1). The windows are stacked
+    into one left-padded [num_seqs, window] tensor, unfolded into n-grams and
+    compared with each sequence's current prefix; all bans are written in place
+    with one indexed assignment.
+    """
+    if rows is None:
+        rows = range(len(token_histories))
+    # an empty prefix or a window shorter than an n-gram never bans anything
+    if ngram_size == 1 or window_size < ngram_size:
+        return scores
+    active = [(row, history) for row, history in zip(rows, token_histories) if len(history) >= ngram_size]
+    if not active:
+        return scores
+
+    width = min(window_size, max(len(history) for _, history in active))
+    # -1 padding never equals a token, so padded n-grams never match a prefix
+    windows = torch.tensor([[-1] * (width - len(tail)) + list(tail)
+                            for tail in (history[-width:] for _, history in active)], dtype=torch.long)
+    ngrams = windows.unfold(1, ngram_size, 1)
+    current_prefix = windows[:, width - ngram_size + 1:]
+    matches = (ngrams[..., :-1] == current_prefix[:, None, :]).all(dim=-1)
+
+    seq_idx, ngram_idx = matches.nonzero(as_tuple=True)
+    banned_tokens = ngrams[seq_idx, ngram_idx, -1]
+    if whitelist_token_ids:
+        allowed = ~torch.isin(banned_tokens, torch.tensor(list(whitelist_token_ids), dtype=torch.long))
+        seq_idx, banned_tokens = seq_idx[allowed], banned_tokens[allowed]
+    if banned_tokens.numel():
+        banned_rows = torch.tensor([row for row, _ in active], dtype=torch.long)[seq_idx]
+        scores[banned_rows.to(scores.device), banned_tokens.to(scores.device)] = -float("inf")
+    return scores
+
+
+class RepetitionDetector:
+    """
+    Spots an output that has settled into a loop, so its request can be stopped early.
+
+    The n-gram ban only looks `window_size` tokens back; lines or table rows longer
+    than that can still repeat until max_tokens. For every period p up to max_period
+    the detector tracks how many consecutive tokens equal the token p positions
+    earlier; once the tail is p-periodic for min_repeats periods and at least
+    min_loop_tokens tokens, feed() returns True and `period` holds p.
+
+    Periodicity alone does not tell a degenerate loop from content that really
+    repeats (a table with identical rows, blank form lines), so those pages are
+    stopped too; the PDF script only uses the detector with REPETITION_ABORT.
+    """
+
+    def __init__(self, max_period: int = 512, min_repeats: int = 5, min_loop_tokens: int = 400):
+        for name, value in (('max_period', max_period), ('min_repeats', min_repeats), ('min_loop_tokens', min_loop_tokens)):
+            if not isinstance(value, int) or value <= 0:
+                raise ValueError(f"`{name}` has to be a strictly positive integer, but is {value}")
+        self.max_period = max_period
+        self._periods = np.arange(1, max_period + 1)
+        # run length needed per period: min_repeats copies of the period, and min_loop_tokens tokens
+        self._needed = np.maximum(self._periods * (min_repeats - 1), min_loop_tokens - self._periods)
+        # last max_period tokens, token i at i % max_period; -1 never equals a token
+        self._history = np.full(max_period, -1, dtype=np.int64)
+        # _runs[p - 1]: consecutive latest tokens equal to the token p positions earlier
+        self._runs = np.zeros(max_period, dtype=np.int64)
+        self.num_tokens = 0
+        self.period = None
+
+    def feed(self, token_ids: Sequence[int]) -> bool:
+        """Take the cumulative output token ids; returns True once a loop is found."""
+        if self.period is not None:
+            return True
+        for token in token_ids[self.num_tokens:]:
+            earlier = self._history[(self.num_tokens - self._periods) % self.max_period]
+            matches = earlier == token
+            self._runs += 1
+            self._runs[~matches] = 0
+            self._history[self.num_tokens % self.max_period] = token
+            self.num_tokens += 1
+            looping = self._runs >= self._needed
+            if looping.any():
+                self.period = int(self._periods[looping.argmax()])
+                return True
+        return False
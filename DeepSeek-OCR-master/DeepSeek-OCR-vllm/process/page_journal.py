@@ -0,0 +1,105 @@
+import fcntl
+import hashlib
+import json
+import os
+from typing import Dict, Optional, Tuple
+
+from config import BASE_SIZE, IMAGE_SIZE, MAX_CROPS, MIN_CROPS, MODEL_PATH, TENSOR_PREPROCESS, RENDER_DPI_MODE, PDF_TEXT_FAST_PATH
+from config import REPETITION_ABORT, REPETITION_MAX_PERIOD, REPETITION_MIN_REPEATS, REPETITION_MIN_TOKENS, TOKEN_BUDGET_MODE
+from process.result_cache import sampling_key
+
+
+def job_fingerprint(pdf_path: str, prompt: str, sampling_params, cropping: bool) -> str:
+    """
+    Identity of a PDF job: the PDF's bytes, the prompt, the render and preprocessing
+    settings (render dpi mode, whether text-native pages skip OCR), the model, the
+    sampling parameters, the per-page token budget mode and the repetition detector
+    settings (pages cut off by the detector or the budget depend on them). A journal
+    is only resumed by the same job.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    settings = (MODEL_PATH, BASE_SIZE, IMAGE_SIZE, cropping, MIN_CROPS, MAX_CROPS, TENSOR_PREPROCESS,
+                RENDER_DPI_MODE, PDF_TEXT_FAST_PATH, prompt, sampling_key(sampling_params), TOKEN_BUDGET_MODE,
+                REPETITION_ABORT, REPETITION_MAX_PERIOD, REPETITION_MIN_REPEATS, REPETITION_MIN_TOKENS)
+    digest.update(repr(settings).encode())
+    with open(pdf_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class JournalInUseError(RuntimeError):
+    """The journal is held by another PageJournal (this or another process)."""
+
+
+class PageJournal:
+    """
+    Append-only record of finished pages, one JSON line per page, fsync'd as written.
+
+    The first line holds the job fingerprint. Opened with `resume`, the pages of an
+    existing journal for the same job are loaded into `pages` (page_idx -> (text,
+    finish_reason)) and new pages are appended after them; a line cut short by a crash
+    is dropped. Without `resume` an existing journal is started over; resuming a
+    journal written for another job raises ValueError.
+
+    The file is locked (flock) while open, so two runs of the same job never write
+    to it at once: the second one gets JournalInUseError.
+    """
+
+    def __init__(self, path: str, fingerprint: str, resume: bool = False):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.pages: Dict[int, Tuple[str, Optional[str]]] = {}
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # opened without truncating: the file may belong to a run holding the lock
+        self._file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+        try:
+            try:
+                fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise JournalInUseError(f"journal {path} is in use by another run of the same job") from None
+            valid_bytes = self._load() if resume else 0
+        except BaseException:
+            self._file.close()
+            raise
+        self._file.truncate(valid_bytes)
+        self._file.seek(valid_bytes)
+        if not valid_bytes:
+            self._append({'fingerprint': fingerprint})
+
+    def _load(self) -> int:
+        """Read the journal into `pages`; returns the length of its intact prefix."""
+        self._file.seek(0)
+        data = self._file.read()
+        valid_bytes = 0
+        for line in data.splitlines(keepends=True):
+            if not line.endswith(b'\n'):
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if not valid_bytes:
+                if record.get('fingerprint') != self.fingerprint:
+                    raise ValueError(f"journal {self.path} was written for another PDF, prompt or setting; "
+                                     f"run without resuming to start over")
+            else:
+                self.pages[record['page']] = (record['text'], record['finish_reason'])
+            valid_bytes += len(line)
+        return valid_bytes
+
+    def _append(self, record: dict):
+        self._file.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def record(self, page_idx: int, text: str, finish_reason: Optional[str]):
+        """Journal a finished page; pages already journaled are not written again."""
+        if page_idx in self.pages:
+            return
+        self._append({'page': page_idx, 'text': text, 'finish_reason': finish_reason})
+        self.pages[page_idx] = (text, finish_reason)
+
+    def close(self):
+        # closing the file releases the lock
+        self._file.close()
@@ -0,0 +1,189 @@
+import collections
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, Optional, Tuple
+
+import fitz  # PyMuPDF
+import numpy as np
+from PIL import Image
+
+
+def pixmap_to_pil(pixmap: "fitz.Pixmap") -> Image.Image:
+    """
+    Build an RGB PIL image straight from the pixmap's sample buffer.
+
+    The samples are copied out of MuPDF once; for plain RGB pixmaps the image
+    wraps that buffer without a further copy. Alpha is flattened onto white in
+    the array (same result as pasting onto a white background up to rounding).
+    """
+    width, height, n = pixmap.width, pixmap.height, pixmap.n
+    samples = pixmap.samples
+
+    if n == 3 and not pixmap.alpha:
+        return Image.frombuffer('RGB', (width, height), samples, 'raw', 'RGB', pixmap.stride, 1)
+
+    arr = np.frombuffer(samples, dtype=np.uint8).reshape(height, pixmap.stride)[:, :width * n]
+    arr = arr.reshape(height, width, n)
+    if pixmap.alpha:
+        color, alpha = arr[..., :-1].astype(np.uint16), arr[..., -1:].astype(np.uint16)
+        arr = ((color * alpha + 255 * (255 - alpha) + 127) // 255).astype(np.uint8)
+    if arr.shape[-1] == 1:
+        return Image.fromarray(arr[..., 0], 'L').convert('RGB')
+    return Image.fromarray(np.ascontiguousarray(arr), 'RGB')
+
+
+def adaptive_zoom(page: "fitz.Page", dpi: int = 144, cropping: bool = True) -> float:
+    """
+    Smallest zoom at which the rendered page still fills what the processor needs.
+
+    The tile grid is chosen from the page size at `dpi` (the size the fixed-DPI path
+    would render), so the grid and the crop/no-crop decision do not change; the page
+    is then rendered just large enough for that grid's tiles and the global view,
+    instead of being rendered at `dpi` and resized afterwards.
+    """
+    from config import BASE_SIZE, IMAGE_SIZE
+    from process.image_process import count_tiles
+
+    zoom = dpi / 72.0
+    rect = page.rect
+    fixed = (rect * fitz.Matrix(zoom, zoom)).irect
+    if cropping:
+        if fixed.width <= 640 and fixed.height <= 640:
+            # no local views: keep the fixed-DPI size, a larger render would start cropping
+            return zoom
+        num_width_tiles, num_height_tiles = count_tiles(fixed.width, fixed.height, image_size=IMAGE_SIZE)
+        need_width, need_height = IMAGE_SIZE * num_width_tiles, IMAGE_SIZE * num_height_tiles
+        need_long = BASE_SIZE
+    elif IMAGE_SIZE <= 640:
+        # resized straight to image_size x image_size
+        need_width = need_height = IMAGE_SIZE
+        need_long = 0
+    else:
+        # padded to base_size x base_size keeping aspect
+        need_width = need_height = 0
+        need_long = BASE_SIZE
+
+    # +0.5 px keeps the rounded pixmap bounds from falling one pixel short
+    return max((need_width + 0.5) / rect.width,
+               (need_height + 0.5) / rect.height,
+               (need_long + 0.5) / max(rect.width, rect.height))
+
+
+def render_page(page: "fitz.Page", dpi: int = 144, dpi_mode: str = 'fixed', cropping: bool = True) -> Image.Image:
+    """Rasterize a page at `dpi` (dpi_mode='fixed') or at adaptive_zoom (dpi_mode='adaptive')."""
+    if dpi_mode == 'fixed':
+        zoom = dpi / 72.0
+    elif dpi_mode == 'adaptive':
+        zoom = adaptive_zoom(page, dpi, cropping)
+    else:
+        raise ValueError(f"`dpi_mode` has to be 'fixed' or 'adaptive', but is {dpi_mode!r}")
+    pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    return pixmap_to_pil(pixmap)
+
+
+# document handles of a render worker process, most recently used last, keyed by (path, mtime)
+_worker_docs = collections.OrderedDict()
+_WORKER_DOCS = 4
+
+_render_pools = {}
+_render_pools_lock = threading.Lock()
+
+
+def _init_render_worker():
+    Image.MAX_IMAGE_PIXELS = None
+
+
+def _worker_doc(pdf_path, mtime_ns):
+    key = (pdf_path, mtime_ns)
+    doc = _worker_docs.pop(key, None)
+    if doc is None:
+        doc = fitz.open(pdf_path)
+        if len(_worker_docs) >= _WORKER_DOCS:
+            _worker_docs.popitem(last=False)[1].close()
+    _worker_docs[key] = doc
+    return doc
+
+
+def _render_range(pdf_path, mtime_ns, first_page, last_page, dpi, dpi_mode, cropping):
+    doc = _worker_doc(pdf_path, mtime_ns)
+    return [(page_num, render_page(doc[page_num], dpi, dpi_mode, cropping))
+            for page_num in range(first_page, last_page)]
+
+
+def get_render_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    Process-wide pool of `workers` render processes, started once and shared by all callers.
+
+    Workers are spawned, not forked: callers (gradio_app, the PDF script) may hold a CUDA
+    context and other threads. Spawned workers import the main module again, so it must
+    not build the engine at import time; that import (torch, vllm, the tokenizer in
+    config) is the pool's start-up cost, paid once per process. Each worker keeps the
+    last few documents open.
+    """
+    with _render_pools_lock:
+        pool = _render_pools.get(workers)
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=_init_render_worker)
+            _render_pools[workers] = pool
+        return pool
+
+
+def _iter_pdf_images_parallel(pdf_path, dpi, start_page, end_page, workers, chunk_pages, dpi_mode, cropping):
+    ranges = [(first, min(first + chunk_pages, end_page)) for first in range(start_page, end_page, chunk_pages)]
+    executor = get_render_pool(workers)
+    # the mtime tells workers to reopen a path whose file has been replaced
+    mtime_ns = os.stat(pdf_path).st_mtime_ns
+    # reorder buffer: ranges are submitted in page order and drained from the left, so
+    # pages come out in order however the workers finish; at most 2 ranges per worker
+    # are rendered ahead of the consumer
+    in_flight = collections.deque()
+    next_range = 0
+    try:
+        while in_flight or next_range < len(ranges):
+            while next_range < len(ranges) and len(in_flight) < 2 * workers:
+                in_flight.append(executor.submit(_render_range, pdf_path, mtime_ns, *ranges[next_range],
+                                                 dpi, dpi_mode, cropping))
+                next_range += 1
+            for page_num, img in in_flight.popleft().result():
+                yield page_num, img
+    finally:
+        # the pool outlives this call: drop what the consumer no longer wants
+        for future in in_flight:
+            future.cancel()
+
+
+def iter_pdf_images(pdf_path: str, dpi: int = 144, start_page: int = 0, end_page: Optional[int] = None,
+                    workers: int = 1, chunk_pages: int = 4, dpi_mode: str = 'fixed',
+                    cropping: bool = True) -> Iterator[Tuple[int, Image.Image]]:
+    """Lazily render PDF pages to PIL images to avoid high RAM usage.
+
+    Yields (page_index, PIL.Image) for each page in [start_page, end_page).
+    With workers > 1, ranges of chunk_pages pages are rasterized in parallel by
+    the long-lived get_render_pool(workers) processes, which keep their own
+    document handles; pages are still yielded in order. dpi_mode='adaptive' renders each page at the smallest zoom
+    that fills its tile grid (see adaptive_zoom) instead of at `dpi`.
+    """
+    Image.MAX_IMAGE_PIXELS = None
+    doc = fitz.open(pdf_path)
+    try:
+        total = doc.page_count
+        if end_page is None or end_page > total:
+            end_page = total
+
+        start_page = max(0, start_page)
+
+        if workers > 1 and end_page - start_page > chunk_pages:
+            yield from _iter_pdf_images_parallel(pdf_path, dpi, start_page, end_page, workers, chunk_pages,
+                                                 dpi_mode, cropping)
+            return
+
+        for page_num in range(start_page, end_page):
+            img = render_page(doc[page_num], dpi, dpi_mode, cropping)
+            yield page_num, img
+            # Help GC promptly
+            del img
+    finally:
+        doc.close()
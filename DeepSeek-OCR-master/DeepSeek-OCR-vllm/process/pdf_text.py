@@ -0,0 +1,96 @@
+import collections
+from typing import Dict, Iterable
+
+import fitz  # PyMuPDF
+
+
+PAGE_TEXT = 'text'        # born-digital: the text layer is the page content
+PAGE_SCANNED = 'scanned'  # no usable text layer (or an OCR layer over a page image)
+PAGE_MIXED = 'mixed'      # usable text plus images / line art that need the model
+
+
+def _readable_chars(text):
+    chars = [c for c in text if not c.isspace()]
+    # fonts without a unicode map extract as U+FFFD or private-use code points
+    unreadable = sum(1 for c in chars if c == '\ufffd' or '\ue000' <= c <= '\uf8ff')
+    return len(chars), unreadable
+
+
+def classify_page(page: "fitz.Page", min_chars: int = 200, max_unreadable: float = 0.05,
+                  max_image_coverage: float = 0.05, scan_image_coverage: float = 0.8,
+                  max_drawings: int = 20) -> str:
+    """
+    Classify a page from its text layer as PAGE_TEXT, PAGE_SCANNED or PAGE_MIXED.
+
+    A page is text-native when it has at least `min_chars` readable characters,
+    images cover no more than `max_image_coverage` of it and it has at most
+    `max_drawings` vector paths (tables, charts and formulas drawn as line art keep
+    going to the model). A page without usable text, or whose text sits on top of
+    an image covering `scan_image_coverage` of it (a scan with an OCR layer), is scanned.
+    """
+    chars, unreadable = _readable_chars(page.get_text('text'))
+    if chars < min_chars or unreadable > max_unreadable * chars:
+        return PAGE_SCANNED
+
+    page_area = abs(page.rect)
+    image_area = sum(abs(fitz.Rect(info['bbox']) & page.rect) for info in page.get_image_info())
+    image_coverage = min(1.0, image_area / page_area) if page_area else 0.0
+    if image_coverage >= scan_image_coverage:
+        return PAGE_SCANNED
+    if image_coverage > max_image_coverage or len(page.get_drawings()) > max_drawings:
+        return PAGE_MIXED
+    return PAGE_TEXT
+
+
+def classify_pages(doc: "fitz.Document", page_nums: Iterable[int]) -> Dict[int, str]:
+    return {page_num: classify_page(doc[page_num]) for page_num in page_nums}
+
+
+def _join_lines(lines):
+    text = ''
+    for line in lines:
+        if not line:
+            continue
+        if text.endswith('-') and line[:1].islower():
+            # hyphenated line break
+            text = text[:-1] + line
+        elif text:
+            text += ' ' + line
+        else:
+            text = line
+    return text
+
+
+def page_to_markdown(page: "fitz.Page") -> str:
+    """
+    Markdown from the page's text layer: one paragraph per text block, blocks set
+    noticeably larger than the body text become headings.
+    """
+    blocks = [block for block in page.get_text('dict', flags=fitz.TEXTFLAGS_TEXT)['blocks'] if block['type'] == 0]
+
+    # body size: the font size carrying the most characters
+    size_chars = collections.Counter()
+    for block in blocks:
+        for line in block['lines']:
+            for span in line['spans']:
+                size_chars[round(span['size'] * 2) / 2] += len(span['text'].strip())
+    body_size = size_chars.most_common(1)[0][0] if size_chars else 0
+
+    paragraphs = []
+    for block in blocks:
+        lines = [''.join(span['text'] for span in line['spans']).strip() for line in block['lines']]
+        text = _join_lines(lines)
+        if not text:
+            continue
+        size = max(span['size'] for line in block['lines'] for span in line['spans'])
+        if body_size and size >= 1.6 * body_size:
+            text = '# ' + text
+        elif body_size and size >= 1.25 * body_size:
+            text = '## ' + text
+        paragraphs.append(text)
+    return '\n\n'.join(paragraphs)
+
+
+def format_page_stats(stats: Dict[str, int], total_pages: int) -> str:
+    return (f'text-native {stats.get(PAGE_TEXT, 0)}, scanned {stats.get(PAGE_SCANNED, 0)}, '
+            f'mixed {stats.get(PAGE_MIXED, 0)}; OCR skipped on {stats.get(PAGE_TEXT, 0)}/{total_pages} pages')
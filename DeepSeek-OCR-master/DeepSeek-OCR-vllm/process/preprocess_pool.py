@@ -0,0 +1,49 @@
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+import torch
+# importing torch.multiprocessing registers tensor reducers on multiprocessing's pickler:
+# tensors returned by pool workers are moved to shared memory and only a handle is pickled
+import torch.multiprocessing  # noqa: F401
+
+from config import CROP_MODE, NUM_WORKERS, PREPROCESS_BACKEND
+from process.image_process import get_shared_processor
+
+
+# the default 'file_descriptor' strategy keeps one fd open per shared storage (about 6 per
+# page) for as long as the tensor lives, which runs out of fds when many results are held
+_SHARING_STRATEGY = 'file_system'
+
+
+def _init_worker():
+    # one pool process per core; intra-op threads would only oversubscribe
+    torch.set_num_threads(1)
+    torch.multiprocessing.set_sharing_strategy(_SHARING_STRATEGY)
+    get_shared_processor()
+
+
+def preprocess_image(image, cropping=CROP_MODE):
+    """Preprocess a single page; returns the 'image' entry of multi_modal_data."""
+    return get_shared_processor().tokenize_with_images(images=[image], bos=True, eos=True, cropping=cropping)
+
+
+def make_preprocess_executor(backend: str = PREPROCESS_BACKEND, max_workers: int = NUM_WORKERS) -> Executor:
+    """
+    Executor for preprocess_image.
+
+    backend='thread' keeps everything in this process (PIL and torch release the GIL
+    only part of the time). backend='process' runs a process pool: input pages are
+    pickled to the workers and the resulting tensors come back through shared memory
+    files ('file_system' sharing, so held results do not keep file descriptors open).
+    Workers are spawned, not forked: the calling process may already hold a CUDA
+    context, tokenizer and OpenMP threads. Spawned workers import the main module
+    again, so callers build the vLLM engine under `if __name__ == "__main__"`.
+    """
+    if backend == 'thread':
+        return ThreadPoolExecutor(max_workers=max_workers)
+    if backend == 'process':
+        torch.multiprocessing.set_sharing_strategy(_SHARING_STRATEGY)
+        return ProcessPoolExecutor(max_workers=max_workers,
+                                   mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_worker)
+    raise ValueError(f"`backend` has to be 'thread' or 'process', but is {backend!r}")
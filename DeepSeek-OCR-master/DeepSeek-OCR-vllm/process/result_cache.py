@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from config import BASE_SIZE, IMAGE_SIZE, MAX_CROPS, MIN_CROPS, MODEL_PATH, TENSOR_PREPROCESS
+from process.ngram_norepeat import REPETITION_FINISH_REASON
+
+
+def sampling_key(sampling_params) -> str:
+    fields = {name: getattr(sampling_params, name, None) for name in (
+        'temperature', 'top_p', 'top_k', 'min_p', 'seed', 'max_tokens', 'repetition_penalty',
+        'presence_penalty', 'frequency_penalty', 'stop', 'stop_token_ids', 'skip_special_tokens',
+        'include_stop_str_in_output', 'extra_args')}
+    # sets (n-gram whitelist) are written sorted so the key does not depend on set order
+    return json.dumps(fields, sort_keys=True, default=lambda value: sorted(value) if isinstance(value, (set, frozenset)) else repr(value))
+
+
+def result_key(image: Image.Image, prompt: str, sampling_params, cropping: bool) -> str:
+    """
+    Content address of one page's OCR result.
+
+    Covers the rendered page pixels, the prompt, the preprocessing settings, the model
+    and the sampling parameters; with temperature 0 these determine the output.
+    """
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    digest = hashlib.blake2b(digest_size=20)
+    settings = (MODEL_PATH, BASE_SIZE, IMAGE_SIZE, cropping, MIN_CROPS, MAX_CROPS, TENSOR_PREPROCESS,
+                prompt, sampling_key(sampling_params), image.size)
+    digest.update(repr(settings).encode())
+    digest.update(np.asarray(image, dtype=np.uint8).tobytes())
+    return digest.hexdigest()
+
+
+class OcrResultCache:
+    """
+    OCR results on disk, one small JSON file per key, bounded to `max_bytes`.
+
+    Hits refresh the file's mtime and the oldest files are evicted first, so the
+    bound is applied in least-recently-used order. Files are written to a temporary
+    name and renamed, so concurrent runs sharing a directory never read partial entries.
+
+    Eviction rescans the directory, so it goes down to `EVICT_TO` of the bound rather
+    than just under it: the next ~10% of puts write without another rescan.
+    """
+
+    EVICT_TO = 0.9
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.num_bytes = sum(size for _, size, _ in self._entries())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def _entries(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.json'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    yield path, stat.st_size, stat.st_mtime
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        """(text, finish_reason) stored under key, or None."""
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return entry['text'], entry['finish_reason']
+
+    def put(self, key: str, text: str, finish_reason: Optional[str]):
+        # a page cut off by RepetitionDetector depends on the detector settings, which are not in the key
+        if finish_reason == REPETITION_FINISH_REASON:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps({'text': text, 'finish_reason': finish_reason}, ensure_ascii=False).encode('utf-8')
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        try:
+            old_size = os.stat(path).st_size
+        except FileNotFoundError:
+            old_size = 0
+        os.replace(tmp_path, path)
+        with self._lock:
+            # an overwritten entry's bytes are replaced, not added to
+            self.num_bytes += len(data) - old_size
+            if self.num_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # called with the lock held; rescan so entries written by other runs are counted too
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self.num_bytes = sum(size for _, size, _ in entries)
+        low_water = self.max_bytes * self.EVICT_TO
+        for path, size, _ in entries:
+            if self.num_bytes <= low_water:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.num_bytes -= size
+
+    def format_stats(self) -> str:
+        return (f'result cache: {self.hits} hits, {self.misses} misses, '
+                f'{self.num_bytes / 2**20:.1f}/{self.max_bytes / 2**20:.0f} MiB in {self.directory}')
@@ -0,0 +1,98 @@
+import math
+from typing import NamedTuple, Optional
+
+import numpy as np
+from PIL import Image
+
+from config import CROP_MODE, IMAGE_SIZE
+from process.image_process import count_tiles
+
+
+class TokenEstimate(NamedTuple):
+    predicted: int   # expected output length in tokens
+    max_tokens: int  # budget the request is submitted with
+
+
+def ink_density(image: Image.Image, thumb_size: int = 512, threshold: int = 160) -> float:
+    """Fraction of pixels darker than `threshold`, measured on a grayscale thumbnail."""
+    thumb = image.convert('L')
+    factor = max(thumb.width, thumb.height) // thumb_size
+    if factor > 1:
+        thumb = thumb.reduce(factor)
+    return float((np.asarray(thumb) < threshold).mean())
+
+
+def page_tiles(width: int, height: int, cropping: bool = CROP_MODE) -> int:
+    """Number of local tiles the processor cuts the page into (1 when only the global view is used)."""
+    if cropping and (width > 640 or height > 640):
+        num_width_tiles, num_height_tiles = count_tiles(width, height, image_size=IMAGE_SIZE)
+        return num_width_tiles * num_height_tiles
+    return 1
+
+
+class TokenBudgetEstimator:
+    """
+    Picks max_tokens per page from signals available before decoding.
+
+    The expected output length grows with the page's ink density, scaled by its
+    tile grid relative to `reference_tiles` (a full portrait page); when the page
+    has a text layer, its character count is a floor (`chars_per_token` characters
+    per token). The budget is `headroom` times that plus `min_tokens`, rounded up
+    to `round_to` and capped at `max_tokens`. A page that reaches its budget is decoded
+    again with the full `max_tokens`, so a low estimate costs time but never output;
+    the budget does not save KV cache (the V0 engine allocates blocks as tokens are
+    generated, whatever max_tokens is).
+    The default `tokens_per_ink` is a rough guess, not calibrated on a corpus; compare
+    it with the actual lengths TokenBudgetStats reports before relying on it.
+    """
+
+    def __init__(self, max_tokens: int = 4096, min_tokens: int = 512, headroom: float = 1.5,
+                 tokens_per_ink: float = 20000.0, reference_tiles: int = 6, chars_per_token: float = 3.0,
+                 round_to: int = 256, cropping: bool = CROP_MODE):
+        if not 0 < min_tokens <= max_tokens:
+            raise ValueError(f"`min_tokens` has to be in (0, max_tokens], but is {min_tokens}")
+        if headroom < 1.0:
+            raise ValueError(f"`headroom` has to be at least 1.0, but is {headroom}")
+        self.max_tokens = max_tokens
+        self.min_tokens = min_tokens
+        self.headroom = headroom
+        self.tokens_per_ink = tokens_per_ink
+        self.reference_tiles = reference_tiles if cropping else 1
+        self.chars_per_token = chars_per_token
+        self.round_to = round_to
+        self.cropping = cropping
+
+    def estimate(self, image: Image.Image, text_chars: Optional[int] = None) -> TokenEstimate:
+        tiles = page_tiles(image.width, image.height, self.cropping)
+        predicted = self.tokens_per_ink * ink_density(image) * tiles / self.reference_tiles
+        if text_chars:
+            predicted = max(predicted, text_chars / self.chars_per_token)
+        budget = self.round_to * math.ceil((self.headroom * predicted + self.min_tokens) / self.round_to)
+        return TokenEstimate(int(predicted), min(budget, self.max_tokens))
+
+
+class TokenBudgetStats:
+    """Predicted vs. actual output lengths, and pages that reached their budget (and were rerun)."""
+
+    def __init__(self):
+        self.pages = 0
+        self.predicted = 0
+        self.actual = 0
+        self.abs_error = 0
+        self.under_predicted = 0
+        self.truncated = 0
+
+    def record(self, estimate: TokenEstimate, actual: int, truncated: bool = False):
+        self.pages += 1
+        self.predicted += estimate.predicted
+        self.actual += actual
+        self.abs_error += abs(actual - estimate.predicted)
+        self.under_predicted += actual > estimate.predicted
+        self.truncated += truncated
+
+    def format(self) -> str:
+        if not self.pages:
+            return 'token budget: no pages'
+        return (f'token budget: mean predicted {self.predicted / self.pages:.0f}, mean actual {self.actual / self.pages:.0f}, '
+                f'mean abs error {self.abs_error / self.pages:.0f} tokens; under-predicted {self.under_predicted}/{self.pages}, '
+                f'rerun after reaching their budget {self.truncated}/{self.pages}')
@@ -0,0 +1,86 @@
+import collections
+import hashlib
+import threading
+from typing import Hashable, Optional
+
+import numpy as np
+import torch
+from PIL import Image
+
+from config import VISION_CACHE_MB
+
+
+def image_content_hash(image: Image.Image, *settings) -> int:
+    """
+    Non-zero signed 64-bit hash of an image's pixels and the preprocessing settings.
+
+    The preprocessed tensors are a function of exactly these, so equal hashes mean
+    equal pixel_values / images_crop; hashing the source pixels is cheaper than
+    hashing the float tensors. 0 is reserved for "not hashed".
+    """
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(repr((image.size, settings)).encode())
+    digest.update(np.asarray(image, dtype=np.uint8).tobytes())
+    value = int.from_bytes(digest.digest(), 'little', signed=True)
+    return value or 1
+
+
+class VisionEmbeddingCache:
+    """
+    LRU cache of projected vision embeddings, bounded by the bytes of the cached tensors.
+
+    Entries stay on the device they were computed on; hits and misses are counted.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key: Hashable) -> Optional[torch.Tensor]:
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return embedding
+
+    def put(self, key: Hashable, embedding: torch.Tensor):
+        size = embedding.numel() * embedding.element_size()
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.num_bytes -= old.numel() * old.element_size()
+            self._entries[key] = embedding
+            self.num_bytes += size
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.num_bytes -= evicted.numel() * evicted.element_size()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
+
+    def format_stats(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        return (f'vision embedding cache: {self.hits} hits, {self.misses} misses ({hit_rate:.0%}), '
+                f'{len(self._entries)} entries, {self.num_bytes / 2**20:.1f}/{self.max_bytes / 2**20:.0f} MiB')
+
+
+# process-wide cache used by DeepseekOCRForCausalLM; VISION_CACHE_MB = 0 disables it
+vision_embedding_cache = VisionEmbeddingCache(VISION_CACHE_MB * 2**20)
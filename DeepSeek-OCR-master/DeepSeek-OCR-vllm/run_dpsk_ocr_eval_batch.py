@@ -7,8 +7,7 @@ if torch.version.cuda == '11.8':
 os.environ['VLLM_USE_V1'] = '0'
 os.environ["CUDA_VISIBLE_DEVICES"] = '0'
 
-from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, MAX_CONCURRENCY, CROP_MODE, NUM_WORKERS
-from concurrent.futures import ThreadPoolExecutor
+from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, MAX_CONCURRENCY
 import glob
 from PIL import Image
 from deepseek_ocr import DeepseekOCRForCausalLM
@@ -16,30 +15,19 @@ from deepseek_ocr import DeepseekOCRForCausalLM
 from vllm.model_executor.models.registry import ModelRegistry
 
 from vllm import LLM, SamplingParams
-from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
-from process.image_process import DeepseekOCRProcessor
+from process.ngram_norepeat import no_repeat_ngram_args
+from process.preprocess_pool import make_preprocess_executor, preprocess_image
+from process.vision_cache import vision_embedding_cache
 ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
 
 
-llm = LLM(
-    model=MODEL_PATH,
-    hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
-    block_size=256,
-    enforce_eager=False,
-    trust_remote_code=True, 
-    max_model_len=8192,
-    swap_space=0,
-    max_num_seqs = MAX_CONCURRENCY,
-    tensor_parallel_size=1,
-    gpu_memory_utilization=0.9,
-)
-
-logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=40, window_size=90, whitelist_token_ids= {128821, 128822})] #window for fast；whitelist_token_ids: <td>,</td>
+# n-gram ban applied by the model to all running images at once; window for fast；whitelist_token_ids: <td>,</td>
+no_repeat_ngram = no_repeat_ngram_args(ngram_size=40, window_size=90, whitelist_token_ids= {128821, 128822})
 
 sampling_params = SamplingParams(
     temperature=0.0,
     max_tokens=8192,
-    logits_processors=logits_processors,
+    extra_args=no_repeat_ngram,
     skip_special_tokens=False,
 )
 
@@ -78,17 +66,30 @@ def re_match(text):
         mathes_other.append(a_match[0])
     return matches, mathes_other
 
-def process_single_image(image):
+def process_single_image(image_features):
     """single image"""
     prompt_in = prompt
     cache_item = {
         "prompt": prompt_in,
-        "multi_modal_data": {"image": DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)},
+        "multi_modal_data": {"image": image_features},
     }
     return cache_item
 
 
 if __name__ == "__main__":
+    # built here rather than at import: preprocess pool workers are spawned and import this module again
+    llm = LLM(
+        model=MODEL_PATH,
+        hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
+        block_size=256,
+        enforce_eager=False,
+        trust_remote_code=True, 
+        max_model_len=8192,
+        swap_space=0,
+        max_num_seqs = MAX_CONCURRENCY,
+        tensor_parallel_size=1,
+        gpu_memory_utilization=0.9,
+    )
 
     # INPUT_PATH = OmniDocBench images path
 
@@ -122,12 +123,12 @@ if __name__ == "__main__":
     #     ]
     #     batch_inputs.extend(cache_list)
 
-    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:  
-        batch_inputs = list(tqdm(
-            executor.map(process_single_image, images),
+    with make_preprocess_executor() as executor:
+        batch_inputs = [process_single_image(image_features) for image_features in tqdm(
+            executor.map(preprocess_image, images),
             total=len(images),
             desc="Pre-processed images"
-        ))
+        )]
 
 
     
@@ -159,3 +160,6 @@ if __name__ == "__main__":
 
         with open(mmd_path, 'w', encoding='utf-8') as afile:
             afile.write(content)
+
+    if vision_embedding_cache.enabled:
+        print(f'{Colors.GREEN}{vision_embedding_cache.format_stats()}{Colors.RESET}')
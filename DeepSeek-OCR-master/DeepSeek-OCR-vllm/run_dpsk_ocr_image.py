@@ -17,8 +17,8 @@ from deepseek_ocr import DeepseekOCRForCausalLM
 from PIL import Image, ImageDraw, ImageFont, ImageOps
 import numpy as np
 from tqdm import tqdm
-from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
-from process.image_process import DeepseekOCRProcessor
+from process.ngram_norepeat import no_repeat_ngram_args
+from process.image_process import get_shared_processor
 from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, CROP_MODE
 
 
@@ -159,12 +159,12 @@ async def stream_generate(image=None, prompt=''):
     )
     engine = AsyncLLMEngine.from_engine_args(engine_args)
     
-    logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=30, window_size=90, whitelist_token_ids= {128821, 128822})] #whitelist: <td>, </td> 
+    no_repeat_ngram = no_repeat_ngram_args(ngram_size=30, window_size=90, whitelist_token_ids= {128821, 128822}) #whitelist: <td>, </td> 
 
     sampling_params = SamplingParams(
         temperature=0.0,
         max_tokens=8192,
-        logits_processors=logits_processors,
+        extra_args=no_repeat_ngram,
         skip_special_tokens=False,
         # ignore_eos=False,
         
@@ -211,7 +211,7 @@ if __name__ == "__main__":
     
     if '<image>' in PROMPT:
 
-        image_features = DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)
+        image_features = get_shared_processor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)
     else:
         image_features = ''
 
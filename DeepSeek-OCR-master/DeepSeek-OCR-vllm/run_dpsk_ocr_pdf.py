@@ -4,9 +4,11 @@ import img2pdf
 import io
 import re
 import argparse
+import collections
+import queue
+import threading
 from tqdm import tqdm
 import torch
-from concurrent.futures import ThreadPoolExecutor
  
 
 if torch.version.cuda == '11.8':
@@ -15,7 +17,9 @@ os.environ['VLLM_USE_V1'] = '0'
 os.environ["CUDA_VISIBLE_DEVICES"] = '0'
 
 
-from config import MODEL_PATH, SKIP_REPEAT, MAX_CONCURRENCY, NUM_WORKERS, CROP_MODE
+from config import MODEL_PATH, SKIP_REPEAT, MAX_CONCURRENCY, CROP_MODE, PIPELINE_DEPTH, RENDER_WORKERS, RENDER_DPI_MODE, PDF_TEXT_FAST_PATH
+from config import REPETITION_ABORT, REPETITION_MAX_PERIOD, REPETITION_MIN_REPEATS, REPETITION_MIN_TOKENS, TOKEN_BUDGET_MODE
+from config import RESULT_CACHE_DIR, RESULT_CACHE_MB
 
 from PIL import Image, ImageDraw, ImageFont
 import numpy as np
@@ -24,32 +28,25 @@ from deepseek_ocr import DeepseekOCRForCausalLM
 from vllm.model_executor.models.registry import ModelRegistry
 
 from vllm import LLM, SamplingParams
-from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
-from process.image_process import DeepseekOCRProcessor
+from process.ngram_norepeat import REPETITION_FINISH_REASON, RepetitionDetector, no_repeat_ngram_args
+from process.preprocess_pool import make_preprocess_executor, preprocess_image
+from process.pdf_render import iter_pdf_images
+from process.pdf_text import PAGE_TEXT, classify_page, format_page_stats, page_to_markdown
+from process.token_budget import TokenBudgetEstimator, TokenBudgetStats
+from process.result_cache import OcrResultCache, result_key
+from process.page_journal import PageJournal, job_fingerprint
+from process.vision_cache import vision_embedding_cache
 
 ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
 
 
-llm = LLM(
-    model=MODEL_PATH,
-    hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
-    block_size=256,
-    enforce_eager=False,
-    trust_remote_code=True, 
-    max_model_len=8192,
-    swap_space=0,
-    max_num_seqs=MAX_CONCURRENCY,
-    tensor_parallel_size=1,
-    gpu_memory_utilization=0.9,
-    disable_mm_preprocessor_cache=True
-)
-
-logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=20, window_size=50, whitelist_token_ids= {128821, 128822})] #window for fast；whitelist_token_ids: <td>,</td>
+# n-gram ban applied by the model to all running pages at once; window for fast；whitelist_token_ids: <td>,</td>
+no_repeat_ngram = no_repeat_ngram_args(ngram_size=20, window_size=50, whitelist_token_ids= {128821, 128822})
 
 sampling_params = SamplingParams(
     temperature=0.0,
     max_tokens=4096,  # Reduced from 8192 to avoid timeouts on complex pages
-    logits_processors=logits_processors,
+    extra_args=no_repeat_ngram,
     skip_special_tokens=False,
     include_stop_str_in_output=True,
 )
@@ -62,55 +59,41 @@ class Colors:
     BLUE = '\033[34m'
     RESET = '\033[0m' 
 
+def iter_pdf_images_high_quality(pdf_path, dpi=144, image_format="PNG"):
+    """
+    pdf2images, one page at a time
+    """
+    # pages are built from the raw pixmap samples (RGB, no alpha), so image_format no longer matters
+    for _, img in iter_pdf_images(pdf_path, dpi=dpi, workers=RENDER_WORKERS, dpi_mode=RENDER_DPI_MODE, cropping=CROP_MODE):
+        yield img
+
+
 def pdf_to_images_high_quality(pdf_path, dpi=144, image_format="PNG"):
     """
     pdf2images
     """
-    images = []
-    
-    pdf_document = fitz.open(pdf_path)
-    
-    zoom = dpi / 72.0
-    matrix = fitz.Matrix(zoom, zoom)
-    
-    for page_num in range(pdf_document.page_count):
-        page = pdf_document[page_num]
+    return list(iter_pdf_images_high_quality(pdf_path, dpi=dpi, image_format=image_format))
 
-        pixmap = page.get_pixmap(matrix=matrix, alpha=False)
-        Image.MAX_IMAGE_PIXELS = None
 
-        if image_format.upper() == "PNG":
-            img_data = pixmap.tobytes("png")
-            img = Image.open(io.BytesIO(img_data))
-        else:
-            img_data = pixmap.tobytes("png")
-            img = Image.open(io.BytesIO(img_data))
-            if img.mode in ('RGBA', 'LA'):
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                img = background
-        
-        images.append(img)
-    
-    pdf_document.close()
-    return images
+def pil_to_jpeg_bytes(img):
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    img_buffer = io.BytesIO()
+    img.save(img_buffer, format='JPEG', quality=95)
+    return img_buffer.getvalue()
+
 
 def pil_to_pdf_img2pdf(pil_images, output_path):
 
-    if not pil_images:
+    jpeg_to_pdf_img2pdf([pil_to_jpeg_bytes(img) for img in pil_images], output_path)
+
+
+def jpeg_to_pdf_img2pdf(image_bytes_list, output_path):
+
+    if not image_bytes_list:
         return
-    
-    image_bytes_list = []
-    
-    for img in pil_images:
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        img_buffer = io.BytesIO()
-        img.save(img_buffer, format='JPEG', quality=95)
-        img_bytes = img_buffer.getvalue()
-        image_bytes_list.append(img_bytes)
-    
+
     try:
         pdf_bytes = img2pdf.convert(image_bytes_list)
         with open(output_path, "wb") as f:
@@ -221,125 +204,384 @@ def process_image_with_refs(image, ref_texts, jdx, output_path):
     return result_image
 
 
-def process_single_image(image):
+def process_single_image(image_features):
     """single image"""
     prompt_in = prompt
     cache_item = {
         "prompt": prompt_in,
-        "multi_modal_data": {"image": DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)},
+        "multi_modal_data": {"image": image_features},
     }
     return cache_item
 
 
-if __name__ == "__main__":
-    # Parse command line arguments
-    parser = argparse.ArgumentParser(description='DeepSeek OCR PDF Processing')
-    parser.add_argument('--input_path', type=str, required=True, help='Input PDF file path')
-    parser.add_argument('--output_path', type=str, required=True, help='Output directory path')
-    parser.add_argument('--prompt', type=str, default='<image>\n<|grounding|>Convert the document to markdown.', help='OCR prompt')
-    
-    args = parser.parse_args()
-    
-    INPUT_PATH = args.input_path
-    OUTPUT_PATH = args.output_path
-    PROMPT = args.prompt
+def journal_path(input_path, output_path):
+    """Page journal of a PDF job, next to its outputs."""
+    return output_path + '/' + input_path.split('/')[-1].replace('.pdf', '_journal.jsonl')
 
-    os.makedirs(OUTPUT_PATH, exist_ok=True)
-    os.makedirs(f'{OUTPUT_PATH}/images', exist_ok=True)
-    
-    print(f'{Colors.RED}PDF loading .....{Colors.RESET}')
 
+class PdfOutputWriter:
+    """Writes finished pages to the .mmd files as they arrive (in page order)."""
 
-    images = pdf_to_images_high_quality(INPUT_PATH)
+    def __init__(self, input_path, output_path):
+        self.output_path = output_path
+        file_name = input_path.split('/')[-1]
+        self.mmd_det_path = output_path + '/' + file_name.replace('.pdf', '_det.mmd')
+        self.mmd_path = output_path + '/' + file_name.replace('pdf', 'mmd')
+        self.pdf_out_path = output_path + '/' + file_name.replace('.pdf', '_layouts.pdf')
+        self.det_file = open(self.mmd_det_path, 'w', encoding='utf-8')
+        self.mmd_file = open(self.mmd_path, 'w', encoding='utf-8')
+        # layouts are kept as JPEG bytes, not PIL images, until the layout PDF is written
+        self.layout_jpegs = []
+        self.jdx = 0
 
+    def write_page(self, content, img):
+        if '<｜end▁of▁sentence｜>' in content: # repeat no eos
+            content = content.replace('<｜end▁of▁sentence｜>', '')
+        else:
+            if SKIP_REPEAT:
+                return
 
-    prompt = PROMPT
+        page_num = '\n<--- Page Split --->'
 
-    # batch_inputs = []
+        self.det_file.write(content + f'\n{page_num}\n')
 
-    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:  
-        batch_inputs = list(tqdm(
-            executor.map(process_single_image, images),
-            total=len(images),
-            desc="Pre-processed images"
-        ))
+        image_draw = img.copy()
 
+        matches_ref, matches_images, mathes_other = re_match(content)
+        # print(matches_ref)
+        result_image = process_image_with_refs(image_draw, matches_ref, self.jdx, self.output_path)
 
-    # for image in tqdm(images):
+        self.layout_jpegs.append(pil_to_jpeg_bytes(result_image))
 
-    #     prompt_in = prompt
-    #     cache_list = [
-    #         {
-    #             "prompt": prompt_in,
-    #             "multi_modal_data": {"image": DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)},
-    #         }
-    #     ]
-    #     batch_inputs.extend(cache_list)
+        for idx, a_match_image in enumerate(matches_images):
+            content = content.replace(a_match_image, f'![](images/' + str(self.jdx) + '_' + str(idx) + '.jpg)\n')
 
+        for idx, a_match_other in enumerate(mathes_other):
+            content = content.replace(a_match_other, '').replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:').replace('\n\n\n\n', '\n\n').replace('\n\n\n', '\n\n')
 
-    # Process in smaller batches to avoid timeout
-    batch_size = 1  # Reduced from 5 to avoid timeouts on complex pages
-    outputs_list = []
-    for i in range(0, len(batch_inputs), batch_size):
-        sub_batch = batch_inputs[i:i + batch_size]
-        sub_outputs = llm.generate(sub_batch, sampling_params)
-        outputs_list.extend(sub_outputs)
+        self.mmd_file.write(content + f'\n{page_num}\n')
+        self.det_file.flush()
+        self.mmd_file.flush()
 
+        self.jdx += 1
 
-    output_path = OUTPUT_PATH
+    def write_text_page(self, markdown, img):
+        """Page taken from the PDF text layer: no refs to strip, layout page without boxes."""
+        page_num = '\n<--- Page Split --->'
 
-    os.makedirs(output_path, exist_ok=True)
+        self.det_file.write(markdown + f'\n{page_num}\n')
+        self.mmd_file.write(markdown + f'\n{page_num}\n')
+        self.layout_jpegs.append(pil_to_jpeg_bytes(img))
+        self.det_file.flush()
+        self.mmd_file.flush()
 
+        self.jdx += 1
 
-    mmd_det_path = output_path + '/' + INPUT_PATH.split('/')[-1].replace('.pdf', '_det.mmd')
-    mmd_path = output_path + '/' + INPUT_PATH.split('/')[-1].replace('pdf', 'mmd')
-    pdf_out_path = output_path + '/' + INPUT_PATH.split('/')[-1].replace('.pdf', '_layouts.pdf')
-    contents_det = ''
-    contents = ''
-    draw_images = []
-    jdx = 0
-    for output, img in zip(outputs_list, images):
-        content = output.outputs[0].text
+    def close(self):
+        self.det_file.close()
+        self.mmd_file.close()
+        jpeg_to_pdf_img2pdf(self.layout_jpegs, self.pdf_out_path)
 
-        if '<｜end▁of▁sentence｜>' in content: # repeat no eos
-            content = content.replace('<｜end▁of▁sentence｜>', '')
-        else:
-            if SKIP_REPEAT:
-                continue
 
-        
-        page_num = f'\n<--- Page Split --->'
+# finish reason of pages taken from the PDF text layer
+TEXT_LAYER = 'text_layer'
 
-        contents_det += content + f'\n{page_num}\n'
 
-        image_draw = img.copy()
+class PipelineError:
+    """Passed downstream in place of a page when a stage thread fails."""
 
-        matches_ref, matches_images, mathes_other = re_match(content)
-        # print(matches_ref)
-        result_image = process_image_with_refs(image_draw, matches_ref, jdx, OUTPUT_PATH)
+    def __init__(self, exc):
+        self.exc = exc
 
 
-        draw_images.append(result_image)
+def _put_error(out_queue, exc):
+    out_queue.put(PipelineError(exc))
 
 
-        for idx, a_match_image in enumerate(matches_images):
-            content = content.replace(a_match_image, f'![](images/' + str(jdx) + '_' + str(idx) + '.jpg)\n')
+def page_sampling_params(estimate):
+    """sampling_params with the page's estimated max_tokens (a TokenEstimate or None)."""
+    if estimate is None or estimate.max_tokens >= sampling_params.max_tokens:
+        return sampling_params
+    params = sampling_params.clone()
+    params.max_tokens = estimate.max_tokens
+    return params
 
-        for idx, a_match_other in enumerate(mathes_other):
-            content = content.replace(a_match_other, '').replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:').replace('\n\n\n\n', '\n\n').replace('\n\n\n', '\n\n')
 
+def render_stage(pdf_path, out_queue, window, done_queue, text_fast_path=False, page_stats=None, estimator=None,
+                 result_cache=None, journaled=None):
+    """
+    Rasterize pages; `window` bounds pages that are rendered but not yet written.
+
+    With `text_fast_path`, each page is classified from its text layer first and
+    text-native pages go straight to the writer (`done_queue`) as
+    (page_idx, img, markdown, TEXT_LAYER) instead of through preprocessing and the
+    engine; `page_stats` counts the kinds. Pages found in `result_cache` go to the
+    writer with their cached text and finish reason, and so do pages in `journaled`
+    (page_idx -> (text, finish_reason) of a resumed journal). Pages for the model are forwarded
+    as (page_idx, img, estimate, cache_key): estimate is the `estimator`'s TokenEstimate
+    for the page (None without an estimator), cache_key its result_key (None without a cache).
+    """
+    doc = None
+    try:
+        if text_fast_path or estimator is not None:
+            doc = fitz.open(pdf_path)
+        pages = iter_pdf_images_high_quality(pdf_path)
+        page_idx = 0
+        while True:
+            window.acquire()
+            img = next(pages, None)
+            if img is None:
+                break
+            if journaled and page_idx in journaled:
+                text, finish_reason = journaled[page_idx]
+                done_queue.put((page_idx, img, text, finish_reason))
+                page_idx += 1
+                continue
+            if text_fast_path:
+                page_kind = classify_page(doc[page_idx])
+                page_stats[page_kind] += 1
+                if page_kind == PAGE_TEXT:
+                    done_queue.put((page_idx, img, page_to_markdown(doc[page_idx]), TEXT_LAYER))
+                    page_idx += 1
+                    continue
+            estimate = None
+            if estimator is not None:
+                estimate = estimator.estimate(img, len(doc[page_idx].get_text('text').strip()))
+            cache_key = None
+            if result_cache is not None:
+                cache_key = result_key(img, prompt, page_sampling_params(estimate), CROP_MODE)
+                cached = result_cache.get(cache_key)
+                if cached is not None:
+                    text, finish_reason = cached
+                    done_queue.put((page_idx, img, text, finish_reason))
+                    page_idx += 1
+                    continue
+            out_queue.put((page_idx, img, estimate, cache_key))
+            page_idx += 1
+        out_queue.put(None)
+    except Exception as e:
+        _put_error(out_queue, e)
+    finally:
+        if doc is not None:
+            doc.close()
 
-        contents += content + f'\n{page_num}\n'
 
+def preprocess_stage(in_queue, out_queue, executor):
+    """Hand pages to the preprocessing pool; futures are forwarded in page order."""
+    try:
+        while True:
+            item = in_queue.get()
+            if item is None or isinstance(item, PipelineError):
+                out_queue.put(item)
+                return
+            page_idx, img, estimate, cache_key = item
+            out_queue.put((page_idx, img, estimate, cache_key, executor.submit(preprocess_image, img)))
+    except Exception as e:
+        _put_error(out_queue, e)
 
-        jdx += 1
 
-    with open(mmd_det_path, 'w', encoding='utf-8') as afile:
-        afile.write(contents_det)
+def engine_stage(engine, in_queue, out_queue, budget_stats=None, result_cache=None):
+    """
+    Feed preprocessed pages to the engine as they become ready and step it.
+
+    New pages are admitted while fewer than MAX_CONCURRENCY are running, so
+    later pages keep rendering and preprocessing while earlier ones decode.
+    Finished requests are forwarded as (page_idx, img, text, finish_reason). With
+    REPETITION_ABORT, a request whose output loops is aborted right away and
+    forwarded with finish_reason REPETITION_FINISH_REASON.
+
+    A page with a token estimate is submitted with the estimate's max_tokens
+    (page_sampling_params); a page that reaches that cap is submitted again with
+    the full max_tokens, so the estimate never cuts a page short. `budget_stats`
+    records predicted against actual lengths. Results of pages with a cache key
+    are stored in `result_cache`.
+    """
+    running = {}
+    waiting = collections.deque()
+    exhausted = False
+
+    def submit(request_id, page_idx, img, estimate, cache_key, request):
+        engine.add_request(request_id, request, page_sampling_params(estimate))
+        detector = RepetitionDetector(REPETITION_MAX_PERIOD, REPETITION_MIN_REPEATS,
+                                      REPETITION_MIN_TOKENS) if REPETITION_ABORT else None
+        running[request_id] = (page_idx, img, estimate, cache_key, request, detector)
+
+    def finish(page_idx, img, text, finish_reason, cache_key):
+        if cache_key is not None:
+            result_cache.put(cache_key, text, finish_reason)
+        out_queue.put((page_idx, img, text, finish_reason))
+
+    while not exhausted or waiting or running:
+        while len(running) < MAX_CONCURRENCY:
+            idle = not running
+            if not waiting:
+                if exhausted:
+                    break
+                try:
+                    item = in_queue.get(block=idle)
+                except queue.Empty:
+                    break
+                if isinstance(item, PipelineError):
+                    raise item.exc
+                if item is None:
+                    exhausted = True
+                    continue
+                waiting.append(item)
+            page_idx, img, estimate, cache_key, future = waiting[0]
+            # only block on preprocessing when there is nothing to decode meanwhile
+            if not (idle or future.done()):
+                break
+            waiting.popleft()
+            submit(str(page_idx), page_idx, img, estimate, cache_key, process_single_image(future.result()))
+
+        if running:
+            for request_output in engine.step():
+                output = request_output.outputs[0]
+                if request_output.finished:
+                    page_idx, img, estimate, cache_key, request, _ = running.pop(request_output.request_id)
+                    cut_by_estimate = (output.finish_reason == 'length'
+                                       and page_sampling_params(estimate) is not sampling_params)
+                    if budget_stats is not None and estimate is not None:
+                        budget_stats.record(estimate, len(output.token_ids), cut_by_estimate)
+                    if cut_by_estimate:
+                        # the estimate was too low: decode the page again with the full budget
+                        submit(f'{page_idx}-full', page_idx, img, None, cache_key, request)
+                        continue
+                    finish(page_idx, img, output.text, output.finish_reason, cache_key)
+                    continue
+                page_idx, img, estimate, cache_key, _, detector = running[request_output.request_id]
+                if detector is not None and detector.feed(output.token_ids):
+                    engine.abort_request(request_output.request_id)
+                    del running[request_output.request_id]
+                    print(f'{Colors.YELLOW}page {page_idx + 1}: output loops every {detector.period} tokens, '
+                          f'stopped after {detector.num_tokens} tokens{Colors.RESET}')
+                    finish(page_idx, img, output.text, REPETITION_FINISH_REASON, cache_key)
+    out_queue.put(None)
+
+
+def write_stage(in_queue, writer, window, progress, journal=None):
+    """
+    Write finished pages in page order; releases one `window` slot per page written.
 
-    with open(mmd_path, 'w', encoding='utf-8') as afile:
-        afile.write(contents)
+    Pages are added to `journal` as they arrive, before waiting for earlier pages.
+    """
+    next_page = 0
+    finished = {}
+    while True:
+        item = in_queue.get()
+        if item is None:
+            return
+        page_idx, img, content, finish_reason = item
+        if journal is not None:
+            journal.record(page_idx, content, finish_reason)
+        finished[page_idx] = (img, content, finish_reason)
+        while next_page in finished:
+            img, content, finish_reason = finished.pop(next_page)
+            try:
+                if finish_reason == TEXT_LAYER:
+                    writer.write_text_page(content, img)
+                else:
+                    writer.write_page(content, img)
+            except Exception as e:
+                print(f'{Colors.RED}page {next_page + 1}: {e}{Colors.RESET}')
+            window.release()
+            progress.update(1)
+            next_page += 1
 
 
-    pil_to_pdf_img2pdf(draw_images, pdf_out_path)
+if __name__ == "__main__":
+    # built here rather than at import: preprocess pool workers are spawned and import this module again
+    llm = LLM(
+        model=MODEL_PATH,
+        hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
+        block_size=256,
+        enforce_eager=False,
+        trust_remote_code=True, 
+        max_model_len=8192,
+        swap_space=0,
+        max_num_seqs=MAX_CONCURRENCY,
+        tensor_parallel_size=1,
+        gpu_memory_utilization=0.9,
+        disable_mm_preprocessor_cache=True
+    )
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='DeepSeek OCR PDF Processing')
+    parser.add_argument('--input_path', type=str, required=True, help='Input PDF file path')
+    parser.add_argument('--output_path', type=str, required=True, help='Output directory path')
+    parser.add_argument('--prompt', type=str, default='<image>\n<|grounding|>Convert the document to markdown.', help='OCR prompt')
+    parser.add_argument('--resume', action='store_true', help='Skip pages recorded in the journal of an earlier run of the same job')
+    
+    args = parser.parse_args()
+    
+    INPUT_PATH = args.input_path
+    OUTPUT_PATH = args.output_path
+    PROMPT = args.prompt
+
+    os.makedirs(OUTPUT_PATH, exist_ok=True)
+    os.makedirs(f'{OUTPUT_PATH}/images', exist_ok=True)
+    
+    print(f'{Colors.RED}PDF loading .....{Colors.RESET}')
+
+    with fitz.open(INPUT_PATH) as pdf_document:
+        num_pages = pdf_document.page_count
+
+
+    prompt = PROMPT
 
+    # render -> preprocess -> engine -> write, each stage in its own thread connected by
+    # bounded queues; at most `window` pages are held anywhere in the pipeline
+    window = threading.BoundedSemaphore(MAX_CONCURRENCY + 3 * PIPELINE_DEPTH)
+    rendered = queue.Queue(maxsize=PIPELINE_DEPTH)
+    preprocessed = queue.Queue(maxsize=PIPELINE_DEPTH)
+    generated = queue.Queue(maxsize=PIPELINE_DEPTH)
+
+    # every finished page is journaled (fsync'd); --resume rebuilds the outputs from it and OCRs only the rest.
+    # The journal lock is taken before the writer empties the outputs, so a second run of a job that is
+    # still going fails here without touching its files.
+    journal = PageJournal(journal_path(INPUT_PATH, OUTPUT_PATH), job_fingerprint(INPUT_PATH, prompt, sampling_params, CROP_MODE),
+                          resume=args.resume)
+    if args.resume:
+        print(f'{Colors.GREEN}resuming: {len(journal.pages)}/{num_pages} pages journaled in {journal.path}{Colors.RESET}')
+    writer = PdfOutputWriter(INPUT_PATH, OUTPUT_PATH)
+    progress = tqdm(total=num_pages, desc="Pages")
+    # text-native pages skip the model and are handed to the writer by the render stage
+    page_stats = collections.Counter()
+    # per-page max_tokens cap from the tile grid, ink density and text layer
+    if TOKEN_BUDGET_MODE == 'adaptive':
+        estimator = TokenBudgetEstimator(max_tokens=sampling_params.max_tokens)
+        budget_stats = TokenBudgetStats()
+    elif TOKEN_BUDGET_MODE == 'fixed':
+        estimator = budget_stats = None
+    else:
+        raise ValueError(f"`TOKEN_BUDGET_MODE` has to be 'fixed' or 'adaptive', but is {TOKEN_BUDGET_MODE!r}")
+    # pages OCRed before (same pixels, prompt, settings) are taken from disk instead of the engine
+    result_cache = OcrResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MB * 2**20) if RESULT_CACHE_DIR else None
+
+    with make_preprocess_executor() as executor:
+        stages = [
+            threading.Thread(target=render_stage, args=(INPUT_PATH, rendered, window, generated, PDF_TEXT_FAST_PATH,
+                                                      page_stats, estimator, result_cache, dict(journal.pages)), daemon=True),
+            threading.Thread(target=preprocess_stage, args=(rendered, preprocessed, executor), daemon=True),
+            threading.Thread(target=write_stage, args=(generated, writer, window, progress, journal), daemon=True),
+        ]
+        for stage in stages:
+            stage.start()
+
+        engine_stage(llm.llm_engine, preprocessed, generated, budget_stats, result_cache)
+
+        for stage in stages:
+            stage.join()
+
+    progress.close()
+    writer.close()
+    journal.close()
+
+    if PDF_TEXT_FAST_PATH:
+        print(f'{Colors.GREEN}{format_page_stats(page_stats, num_pages)}{Colors.RESET}')
+    if budget_stats is not None:
+        print(f'{Colors.GREEN}{budget_stats.format()}{Colors.RESET}')
+    if result_cache is not None:
+        print(f'{Colors.GREEN}{result_cache.format_stats()}{Colors.RESET}')
+    if vision_embedding_cache.enabled:
+        print(f'{Colors.GREEN}{vision_embedding_cache.format_stats()}{Colors.RESET}')
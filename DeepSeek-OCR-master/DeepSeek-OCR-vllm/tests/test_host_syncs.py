@@ -0,0 +1,73 @@
+"""
+The image embedding path must not read device values on the host.
+
+Every host read of a CUDA tensor (.item(), .tolist(), truth tests, int()/float())
+waits for the device; on CPU the same calls are made, so counting them in a CPU
+run counts the synchronizations a GPU run would do.
+"""
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("vllm")
+
+from deepseek_ocr import DeepseekOCRForCausalLM  # noqa: E402
+from process.vision_cache import vision_embedding_cache  # noqa: E402
+
+N_DIM = 8
+# the stub encoder returns a 4x4 feature grid per view
+GRID = 4
+
+
+def _stub_model():
+    model = DeepseekOCRForCausalLM.__new__(DeepseekOCRForCausalLM)
+    torch.nn.Module.__init__(model)
+    model.image_newline = torch.zeros(N_DIM)
+    model.view_seperator = torch.zeros(N_DIM)
+    model._encode_views = lambda views: torch.zeros(views.size(0), GRID * GRID, N_DIM)
+    return model
+
+
+def _image_inputs():
+    # two images as tokenize_with_images lays them out: a 2x3 tile grid and one
+    # without local views (1x1 all-zero placeholder crop)
+    return {
+        "pixel_values": torch.zeros(2, 1, 3, 8, 8),
+        "images_crop": [torch.zeros(1, 2, 3, 3, 4, 4), torch.zeros(1, 1, 1, 3, 4, 4)],
+        "images_spatial_crop": torch.tensor([[[3, 2]], [[1, 1]]]),
+        "image_hash": torch.tensor([[11], [12]]),
+    }
+
+
+@pytest.fixture
+def host_reads(monkeypatch):
+    counts = {}
+    for name in ("item", "tolist", "__bool__", "__int__", "__float__"):
+        original = getattr(torch.Tensor, name)
+
+        def counted(self, *args, _name=name, _original=original, **kwargs):
+            counts[_name] = counts.get(_name, 0) + 1
+            return _original(self, *args, **kwargs)
+
+        monkeypatch.setattr(torch.Tensor, name, counted)
+    return counts
+
+
+def test_embedding_path_has_no_host_reads(host_reads, monkeypatch):
+    monkeypatch.setattr(vision_embedding_cache, "max_bytes", 0)
+    model = _stub_model()
+
+    embeddings = model.get_multimodal_embeddings(**_image_inputs())
+
+    assert host_reads == {}
+    # 2x3 grid: local rows (2*4) x (3*4 + newline), global 4 x (4 + newline), separator
+    assert embeddings[0].shape == ((2 * GRID) * (3 * GRID + 1) + GRID * (GRID + 1) + 1, N_DIM)
+    assert embeddings[1].shape == (GRID * (GRID + 1) + 1, N_DIM)
+
+
+def test_placeholder_input_has_no_host_reads(host_reads):
+    model = _stub_model()
+    # a prompt tokenized without images: images_spatial_crop has no tile pair
+    inputs = dict(_image_inputs(), images_spatial_crop=torch.zeros(2, 1, 1, dtype=torch.long))
+
+    assert model.get_multimodal_embeddings(**inputs) is None
+    assert host_reads == {}